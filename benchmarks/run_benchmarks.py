@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+'''
+Benchmarks of the pipeline engine, the pins and the serializers. Everything
+runs on the local machine. The results are written as JSON, so that the
+results of different runs can be compared with --compare
+'''
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'examples'))
+from clutils.pins import DictionaryPin, ScalarPin, PinMultiplex, TextFilePin
+from clutils.pipeline import Pipeline
+from clutils.building_blocks import SimpleJob
+from clutils.executors import GridExecutor, LocalPoolExecutor
+from clutils.config_loader import ConfigMatcher
+
+
+def timed(f, repeat):
+    '''Returns the best time of repeat runs of f'''
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def make_corpus(filename, n_lines, vocabulary=10000, compress=False):
+    random.seed(0)
+    words = ['word{0}'.format(i) for i in xrange(vocabulary)]
+    f = gzip.open(filename, 'wb') if compress else open(filename, 'w')
+    with f:
+        for _ in xrange(n_lines):
+            f.write('{0}\tPOS\tlemma\n'.format(random.choice(words)))
+    return filename
+
+
+def bench_dictionary_pin(tmp_dir, args):
+    counter = Counter(dict(('word{0}'.format(i), i)
+                           for i in xrange(args.n_keys)))
+    pin = DictionaryPin("output", Counter)
+    pin.initialize(tmp_dir)
+    pin.write(counter)
+    write_time = timed(pin.close, args.repeat)
+    read_time = timed(pin.read, args.repeat)
+    return {'dictionary_pin_write': {'seconds': write_time,
+                                     'keys_per_second': args.n_keys / write_time},
+            'dictionary_pin_read': {'seconds': read_time,
+                                    'keys_per_second': args.n_keys / read_time}}
+
+
+def bench_text_file_pin(tmp_dir, args):
+    results = {}
+    for compress in (False, True):
+        name = 'text_file_pin_{0}'.format('gzip' if compress else 'plain')
+        filename = make_corpus(os.path.join(tmp_dir, name), args.n_lines,
+                               compress=compress)
+        pin = TextFilePin("input")
+        pin.open(filename)
+        seconds = timed(lambda: sum(1 for _ in pin.read()), args.repeat)
+        results[name] = {'seconds': seconds,
+                         'lines_per_second': args.n_lines / seconds}
+    return results
+
+
+def bench_pin_multiplex(tmp_dir, args):
+    multiplex = PinMultiplex("input")
+    for i in xrange(args.n_pins):
+        pin = ScalarPin("output")
+        pin.initialize(os.path.join(tmp_dir, str(i)))
+        pin.write(Counter(dict(('word{0}'.format(j), j) for j in xrange(100))))
+        pin.connect_to(multiplex)
+    results = {}
+    for name, read in [
+            ('pin_multiplex_read', multiplex.read),
+            ('pin_multiplex_prefetch', multiplex.read_prefetch),
+            ('pin_multiplex_unordered',
+             lambda: multiplex.read_prefetch(ordered=False))]:
+        seconds = timed(lambda: list(read()), args.repeat)
+        results[name] = {'seconds': seconds,
+                         'pins_per_second': args.n_pins / seconds}
+    return results
+
+
+class _Job(object):
+    pass
+
+
+def bench_apply_config(tmp_dir, args):
+    pipeline = Pipeline(tmp_dir)
+    modules = []
+    for i in xrange(args.n_modules):
+        module = SimpleJob("count", str(i))
+        module.work_path = os.path.join(tmp_dir, "count", str(i))
+        modules.append(module)
+    config = {'*': {'h_cpu': '1:0:0', 'h_vmem': '1G'},
+              'count': dict((str(i), {'h_vmem': '2G'}) for i in xrange(20))}
+    jobs = [_Job() for _ in modules]
+
+    def apply_all():
+        #as Pipeline.run does, compile the configuration once
+        matcher = ConfigMatcher(config, pipeline.work_path)
+        for module, job in zip(modules, jobs):
+            pipeline.apply_config(matcher, module, job)
+    seconds = timed(apply_all, args.repeat)
+    return {'apply_config': {'seconds': seconds,
+                             'modules_per_second': args.n_modules / seconds}}
+
+
+def bench_count_words(tmp_dir, args):
+    from count_words_defs import CountWords, SumCounts
+    corpora = [make_corpus(os.path.join(tmp_dir, 'corpus{0}'.format(i)),
+                           args.n_lines // args.n_corpora)
+               for i in xrange(args.n_corpora)]
+    results = {}
+    for name, make_executor in [
+            ('count_words_serial', lambda: GridExecutor(local=True)),
+            ('count_words_pool', lambda: LocalPoolExecutor())]:
+        #the repeats share the executor, as the runs of a long-lived driver
+        executor = make_executor()
+
+        def run():
+            work_path = os.path.join(tmp_dir, name)
+            shutil.rmtree(work_path, True)
+            pipeline = Pipeline(work_path)
+            sum_module = SumCounts("sum")
+            for corpus in corpora:
+                count_module = CountWords("count", os.path.basename(corpus))
+                count_module.set_args(corpus, False, False)
+                count_module['output'].connect_to(sum_module['input'])
+                pipeline.add_module(count_module)
+            pipeline.add_stage()
+            pipeline.add_module(sum_module)
+            pipeline.run(executor=executor)
+        try:
+            seconds = timed(run, args.repeat)
+        finally:
+            executor.shutdown()
+        results[name] = {'seconds': seconds,
+                         'lines_per_second': args.n_lines / seconds}
+    return results
+
+
+BENCHMARKS = [('dictionary_pin', bench_dictionary_pin),
+              ('text_file_pin', bench_text_file_pin),
+              ('pin_multiplex', bench_pin_multiplex),
+              ('apply_config', bench_apply_config),
+              ('count_words', bench_count_words)]
+
+
+def compare(results, previous):
+    for name in sorted(results):
+        if name not in previous:
+            continue
+        old, new = previous[name]['seconds'], results[name]['seconds']
+        print "{0:<28}{1:>10.3f}s{2:>10.3f}s{3:>9.2f}x".format(name, old, new,
+                                                            old / new)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', help='JSON file for the results')
+    parser.add_argument('-c', '--compare', help='JSON file of a previous run '
+                        'to compare with')
+    parser.add_argument('-b', '--benchmark', action='append',
+                        choices=[name for name, _ in BENCHMARKS],
+                        help='run only this benchmark (can be repeated)')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--n-keys', type=int, default=500000)
+    parser.add_argument('--n-lines', type=int, default=1000000)
+    parser.add_argument('--n-pins', type=int, default=1000)
+    parser.add_argument('--n-modules', type=int, default=5000)
+    parser.add_argument('--n-corpora', type=int, default=8)
+    args = parser.parse_args()
+
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if args.benchmark and name not in args.benchmark:
+            continue
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for result_name, result in sorted(benchmark(tmp_dir, args).items()):
+                print "{0:<28}{1:>10.3f}s".format(result_name,
+                                                  result['seconds'])
+                results[result_name] = result
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.time(),
+                       'host': platform.node(),
+                       'python': platform.python_version(),
+                       'parameters': vars(args),
+                       'results': results}, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
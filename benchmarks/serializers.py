@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+from clutils.serialization import PklSerializer, BinPklSerializer, \
+    MsgpackSerializer, NpySerializer, NpzSerializer
+
+
+def make_counter(n_keys):
+    random.seed(0)
+    return Counter(dict(('word{0}'.format(i), random.randint(1, 1000))
+                        for i in xrange(n_keys)))
+
+
+def measure(serializer, save, value):
+    '''Returns the seconds spent saving and reading the value, and the size
+    of the file'''
+    t0 = time.time()
+    save(serializer, value)
+    t1 = time.time()
+    serializer.read()
+    t2 = time.time()
+    return t1 - t0, t2 - t1, os.path.getsize(serializer.filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=
+    '''Measures the throughput of the serializers''')
+    parser.add_argument('-n', '--n-keys', type=int, default=1000000,
+                        help='number of keys of the benchmarked Counter')
+    args = parser.parse_args()
+
+    counter = make_counter(args.n_keys)
+    benchmarks = [
+        ('pkl', PklSerializer, lambda s, v: s.save_dict(v), counter),
+        ('binpkl', BinPklSerializer, lambda s, v: s.save_dict(v), counter),
+        ('msgpack', MsgpackSerializer, lambda s, v: s.save_dict(v), counter),
+    ]
+    try:
+        import numpy as np
+        array = np.random.rand(args.n_keys)
+        benchmarks += [
+            ('binpkl-array', BinPklSerializer,
+             lambda s, v: s.save_scalar(v), array),
+            ('npy', NpySerializer, lambda s, v: s.save_scalar(v), array),
+            ('npz', NpzSerializer, lambda s, v: s.save_dict(v),
+             {'array': array}),
+        ]
+    except ImportError:
+        pass
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print "{0:<14}{1:>12}{2:>12}{3:>12}".format('serializer', 'size (MB)',
+                                                'save MB/s', 'read MB/s')
+        for name, serializer_type, save, value in benchmarks:
+            serializer = serializer_type(os.path.join(tmp_dir, name))
+            try:
+                save_time, read_time, size = measure(serializer, save, value)
+            except ImportError, e:
+                print "{0:<14}skipped ({1})".format(name, e)
+                continue
+            mb = size / float(1 << 20)
+            print "{0:<14}{1:>12.1f}{2:>12.1f}{3:>12.1f}".format(name, mb,
+                                            mb / save_time, mb / read_time)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
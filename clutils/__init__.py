@@ -1,3 +1,5 @@
 from pipeline import Pipeline, JobModule
-from pins import TextFilePin, PinMultiplex, ScalarPin, DictionaryPin
+from pins import TextFilePin, PinMultiplex, ScalarPin, DictionaryPin, \
+    RecordStreamPin, SharedMemoryPin, TextOutputPin
+from executors import GridExecutor, LocalPoolExecutor, RetryingExecutor
 from config_loader import nodenames
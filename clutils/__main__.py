@@ -0,0 +1,18 @@
+import sys
+
+COMMANDS = {'report': 'clutils.report', 'cache': 'clutils.cache'}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print "usage: python -m clutils {{{0}}} ...".format(
+            ",".join(sorted(COMMANDS)))
+        sys.exit(2)
+    command = sys.argv.pop(1)
+    sys.argv[0] = "clutils {0}".format(command)
+    __import__(COMMANDS[command])
+    sys.modules[COMMANDS[command]].main()
+
+
+if __name__ == "__main__":
+    main()
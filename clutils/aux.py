@@ -1,18 +1,161 @@
 import os
 import errno
+import contextlib
+import socket
+import threading
 from collections import Mapping
 from itertools import chain
 
 
+_deferred = threading.local()
+_claims = threading.local()
+
 #auxiliary functions
 def mkdir_p(path):
+    deferred_paths = getattr(_deferred, 'paths', None)
+    if deferred_paths is not None:
+        deferred_paths.append(path)
+        return
     try:
         os.makedirs(path)
     except OSError as exc: # Python >2.5
         if exc.errno == errno.EEXIST and os.path.isdir(path):
             pass
         else: raise
-        
+
+
+@contextlib.contextmanager
+def deferred_mkdir():
+    '''Inside this context, mkdir_p (in the current thread) records the paths
+    in the yielded list instead of creating the directories'''
+    _deferred.paths = paths = []
+    try:
+        yield paths
+    finally:
+        _deferred.paths = None
+
+
+def temp_filename(filename):
+    '''Name of a temporary file next to filename that is unique for this
+    host, process and thread'''
+    return '{0}.tmp.{1}.{2}.{3}'.format(filename, socket.gethostname(),
+                                        os.getpid(),
+                                        threading.current_thread().ident)
+
+
+@contextlib.contextmanager
+def atomic_open(filename, mode='wb'):
+    '''Opens a temporary file which replaces filename (with a rename) once
+    it's closed without errors, so readers never see a partially written
+    file and concurrent copies of the same job don't corrupt it'''
+    tmp_filename = temp_filename(filename)
+    f = open(tmp_filename, mode)
+    try:
+        yield f
+    except:
+        f.close()
+        os.remove(tmp_filename)
+        raise
+    f.close()
+    commit_file(tmp_filename, filename)
+
+
+class SupersededError(Exception):
+    '''Raised when a copy of a job tries to write its results after another
+    copy of the same job has started writing its own'''
+
+
+class _Claim(object):
+    def __init__(self, path, token, owner):
+        self.filename = os.path.join(path, '.claim-' + token)
+        self.owner = owner
+        self.owned = None
+
+    def acquire(self):
+        if self.owned is None:
+            try:
+                fd = os.open(self.filename,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, self.owner)
+                os.close(fd)
+                self.owned = True
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                with open(self.filename) as f:
+                    self.owned = f.read() == self.owner
+        return self.owned
+
+    def release(self):
+        '''Removes the claim if another copy owns it. Once a copy owns the
+        claim it doesn't read the file again, so the losing copy removes it
+        when it ends, which may be after the pipeline stopped waiting for it'''
+        if self.owned is None:
+            try:
+                with open(self.filename) as f:
+                    self.owned = f.read() == self.owner
+            except IOError:
+                #nobody has written anything yet
+                return
+        if not self.owned:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+
+
+@contextlib.contextmanager
+def claimed_writes(path, claim=None):
+    '''
+    Inside this context, the first file put in place with commit_file (in
+    the current thread) claims path for the copy of the job given by claim,
+    a (token, owner) tuple shared by all the copies of the same job. The
+    files of the other copies are discarded with a SupersededError, so a
+    copy that couldn't be stopped never replaces the results of the winner.
+    Without a claim, files are committed normally
+    '''
+    _claims.claim = claim and _Claim(path, *claim)
+    try:
+        yield
+    finally:
+        if _claims.claim is not None:
+            _claims.claim.release()
+        _claims.claim = None
+
+
+def remove_claim(path, token):
+    try:
+        os.remove(os.path.join(path, '.claim-' + token))
+    except OSError:
+        pass
+
+
+def commit_file(tmp_filename, filename):
+    '''Renames a temporary file to filename, unless another copy of the job
+    has claimed its results (see claimed_writes)'''
+    claim = getattr(_claims, 'claim', None)
+    if claim is not None and not claim.acquire():
+        os.remove(tmp_filename)
+        raise SupersededError("{0} was written by another copy of the "
+                              "job".format(filename))
+    os.rename(tmp_filename, filename)
+
+
+def mkdirs_parallel(paths, threads=16):
+    '''Creates many directories concurrently, which is much faster than
+    doing it serially on network file systems'''
+    paths = sorted(set(paths))
+    if len(paths) <= 1 or threads <= 1:
+        for path in paths:
+            mkdir_p(path)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(threads, len(paths)))
+    try:
+        pool.map(mkdir_p, paths)
+    finally:
+        pool.close()
+
 
 def dict_merge(a, b):
     '''recursively merges dict's. not just simple a['key'] = b['key'], if
@@ -0,0 +1,77 @@
+import cPickle as pickle
+import hashlib
+import os
+from clutils.aux import mkdir_p
+
+#values already loaded in this process, indexed by filename
+_loaded = {}
+
+
+class Broadcast(object):
+    '''
+    Handle to an object that is shared by many jobs (see
+    Pipeline.broadcast). The object is stored once in the work path of the
+    pipeline, and only the handle is pickled with each job. The handles
+    passed to set_args are replaced by their values before calling run.
+    NumPy arrays are memory-mapped instead of loaded
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+
+    @classmethod
+    def create(cls, obj, path):
+        try:
+            import numpy as np
+            is_array = isinstance(obj, np.ndarray) and not obj.dtype.hasobject
+        except ImportError:
+            is_array = False
+        h = hashlib.sha1()
+        if is_array:
+            obj = np.ascontiguousarray(obj)
+            h.update(obj.data)
+            h.update(str(obj.dtype))
+            h.update(str(obj.shape))
+            ext = '.npy'
+        else:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            h.update(data)
+            ext = '.pkl'
+        filename = os.path.join(path, h.hexdigest() + ext)
+        if not os.path.isfile(filename):
+            mkdir_p(path)
+            tmp_filename = filename + '.tmp{0}'.format(os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                if is_array:
+                    np.save(f, obj)
+                else:
+                    f.write(data)
+            os.rename(tmp_filename, filename)
+        return cls(filename)
+
+    def get(self):
+        '''Loads the object (only once per process)'''
+        if self.filename not in _loaded:
+            if self.filename.endswith('.npy'):
+                import numpy as np
+                _loaded[self.filename] = np.load(self.filename, mmap_mode='r')
+            else:
+                with open(self.filename, 'rb') as f:
+                    _loaded[self.filename] = pickle.load(f)
+        return _loaded[self.filename]
+
+    def __repr__(self):
+        return "Broadcast({0})".format(self.filename)
+
+
+def resolve(args):
+    '''Replaces the Broadcast handles in args (or in the lists and tuples in
+    args, e.g. the arguments of a SimpleJob) by their values'''
+    resolved = []
+    for arg in args:
+        if isinstance(arg, Broadcast):
+            arg = arg.get()
+        elif isinstance(arg, (list, tuple)) and \
+                any(isinstance(a, Broadcast) for a in arg):
+            arg = type(arg)(resolve(arg))
+        resolved.append(arg)
+    return resolved
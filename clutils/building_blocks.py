@@ -1,30 +1,217 @@
+import heapq
+import logging
+import os
+import shutil
+from collections import Mapping
+from itertools import groupby
+from operator import itemgetter, add
 from clutils.pipeline import JobModule, Pipeline
-from clutils.pins import ScalarPin, PinMultiplex
+from clutils.pins import ScalarPin, PinMultiplex, RecordStreamPin, \
+    TextOutputPin
+from clutils.serialization import encode_key
+from clutils.compressed import create_compressed, split_ranges, \
+    DEFAULT_BLOCK_SIZE
+from clutils.aux import temp_filename, commit_file, SupersededError
 
 
 class SimpleJob(JobModule):
     def setup(self):
         self.register_pins(ScalarPin("output"))
         
-    def run(self, f, args):
+    def run(self, f, args, combiner=None):
         rv = f(*args)
+        if combiner:
+            rv = combiner(rv)
         self['output'].write(rv)
 
+class CombineByKey(object):
+    '''
+    Combiner for SimpleJob: turns an iterable of (key, value) pairs into a
+    dictionary where the values of each key are combined with combine(a, b)
+    (summed by default)
+    '''
+    def __init__(self, combine=add):
+        self.combine = combine
+
+    def __call__(self, pairs):
+        combined = {}
+        for k, v in pairs:
+            if k in combined:
+                combined[k] = self.combine(combined[k], v)
+            else:
+                combined[k] = v
+        return combined
+
 class MergeJob(JobModule):
     def setup(self):
         self.register_pins(PinMultiplex("input"), ScalarPin("output"))
     
     def run(self, f, args):
-        rv = f(*args + list(self['input'].read()))
+        rv = f(*args + list(self['input'].read_prefetch()))
         self['output'].write(rv)
 
+class StreamMergeJob(JobModule):
+    '''
+    Merges inputs that yield (key, value) pairs sorted by key (e.g. the
+    RecordStreamPins of previous jobs) into a sorted stream where the values
+    of equal keys are combined with combine(a, b). The inputs are read
+    lazily, so the memory used does not depend on their size. An input that
+    is not sorted raises a ValueError.
+    The inputs can also be sorted dictionaries (see SortedDictSerializer),
+    which are ordered by their encoded keys instead, so they are merged (and
+    written) in that order and can't be mixed with record streams
+    '''
+    def setup(self):
+        self.register_pins(PinMultiplex("input"), RecordStreamPin("output"))
+
+    def run(self, combine):
+        inputs = list(self['input'].read())
+        mappings = [isinstance(i, Mapping) for i in inputs]
+        if any(mappings) and not all(mappings):
+            raise ValueError("Sorted dictionaries can't be merged with "
+                             "record streams")
+        merged = heapq.merge(*[_checked_records(i, n, encode_key if m else None)
+                               for n, (i, m) in enumerate(zip(inputs,
+                                                              mappings))])
+        for _, records in groupby(merged, key=itemgetter(0)):
+            _, _, _, key, value = next(records)
+            self['output'].write((key, reduce(combine,
+                                              (r[4] for r in records), value)))
+
+def _checked_records(records, n, sort_key=None):
+    '''Yields (sort key, n, i, key, value) for the i-th (key, value) pair of
+    the n-th input, so that heapq.merge never compares the values. Raises a
+    ValueError if the keys are not sorted'''
+    if isinstance(records, Mapping):
+        records = records.iteritems()
+    previous = previous_key = None
+    for i, (key, value) in enumerate(records):
+        k = sort_key(key) if sort_key else key
+        if i and k < previous:
+            raise ValueError("Input {0} is not sorted: {1!r} comes after "
+                             "{2!r}".format(n, key, previous_key))
+        previous, previous_key = k, key
+        yield k, n, i, key, value
+
+def command_line(command, arguments, shell=False):
+    '''Returns the argument list of a command or, if shell is True, the
+    string to be run by the shell'''
+    if shell:
+        return " ".join([command] + list(arguments))
+    return [command] + list(arguments)
+
+def run_command(command_line, output_filename, error_filename=None,
+                compression=None, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Runs a command, given as a list of arguments or as a string to be run
+    by the shell, writing its standard output into output_filename
+    (compressed with compression, see clutils.compressed) and its standard
+    error into error_filename or, if it's None, into the output.
+    Both are written to temporary files that replace them once the command
+    finishes, as the serializers do.
+    Returns the exit code
+    '''
+    from subprocess import Popen, PIPE, STDOUT
+    shell = isinstance(command_line, basestring)
+    tmp_output = temp_filename(output_filename)
+    tmp_errors = temp_filename(error_filename) if error_filename else None
+    errors = open(tmp_errors, 'wb') if error_filename else None
+    try:
+        if compression is None:
+            #the command writes straight into the file
+            with open(tmp_output, 'wb') as output:
+                exit_code = Popen(command_line, stdout=output,
+                                  stderr=errors or STDOUT, shell=shell).wait()
+        else:
+            f = Popen(command_line, stdout=PIPE, stderr=errors or STDOUT,
+                      shell=shell, bufsize=block_size)
+            output = create_compressed(tmp_output, compression, block_size)
+            try:
+                shutil.copyfileobj(f.stdout, output, block_size)
+            finally:
+                output.close()
+            exit_code = f.wait()
+    except:
+        for filename in (tmp_output, tmp_errors):
+            if filename and os.path.isfile(filename):
+                os.remove(filename)
+        raise
+    finally:
+        if errors:
+            errors.close()
+    try:
+        commit_file(tmp_output, output_filename)
+    except SupersededError:
+        if error_filename:
+            os.remove(tmp_errors)
+        raise
+    if error_filename:
+        commit_file(tmp_errors, error_filename)
+    return exit_code
+
 class CommandLineJob(JobModule):
-    def run(self, command, arguments):
-        from subprocess import Popen, PIPE
-        f = Popen(" ".join([command] + arguments), stdout=PIPE, shell=True)
-        for line in f.stdout:
-            print line.strip()
-        return f.wait()
+    '''
+    Runs a command. Its standard output is stored in the "output" pin, which
+    the following modules can read as a TextFilePin, optionally compressed
+    (e.g. compression='gzip'), and its standard error in
+    <work_path>/stderr.log. With shell=False, the arguments are passed to
+    the command as they are instead of through the shell. The job fails if
+    the command exits with an error
+    '''
+    def setup(self):
+        self.register_pins(TextOutputPin("output"))
+
+    def run(self, command, arguments, compression=None, shell=True):
+        exit_code = run_command(command_line(command, arguments, shell),
+                                self['output'].filename,
+                                os.path.join(self.work_path, 'stderr.log'),
+                                compression)
+        if exit_code != 0:
+            raise RuntimeError("{0}: exit code {1}".format(self, exit_code))
+        return exit_code
+
+class BatchCommandLineJob(JobModule):
+    '''
+    Runs several commands inside a single job, one after another or, if
+    threads > 1, concurrently. The standard output of each command is
+    written to <work_path>/<name>.log (optionally compressed), its standard
+    error to <work_path>/<name>.err and its exit code stored in the
+    "exit_codes" pin, a dictionary indexed by name. The job fails if any of
+    the commands exits with an error
+    '''
+    def setup(self):
+        self.register_pins(ScalarPin("exit_codes"))
+
+    def log_filenames(self):
+        '''Returns the output file of each command, in order'''
+        return [os.path.join(self.work_path, '{0}.log'.format(name))
+                for name, _, _ in self.args[0]]
+
+    def run_command(self, name, command, arguments):
+        filename = os.path.join(self.work_path, name)
+        return name, run_command(command_line(command, arguments, self.shell),
+                                 filename + '.log', filename + '.err',
+                                 self.compression)
+
+    def run(self, commands, threads=1, compression=None, shell=True):
+        '''commands: a list of (name, command, arguments) tuples'''
+        self.compression = compression
+        self.shell = shell
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+            exit_codes = pool.map(lambda c: self.run_command(*c), commands)
+            pool.close()
+        else:
+            exit_codes = [self.run_command(*c) for c in commands]
+        self['exit_codes'].write(dict(exit_codes))
+        failed = [name for name, exit_code in exit_codes if exit_code != 0]
+        for name, exit_code in exit_codes:
+            if exit_code != 0:
+                logging.warning("{0}: exit code {1}".format(name, exit_code))
+        if failed:
+            raise RuntimeError("{0}: {1} commands failed".format(self,
+                                                                 len(failed)))
     
 def create_parallel_pipeline(work_path, f, args_list):
     '''Run a function f with many arguments in parallel'''
@@ -38,18 +225,89 @@ def create_parallel_pipeline(work_path, f, args_list):
     return p
 
 
-def create_map_reduce_pipeline(work_path, m, r, args_list):
-    '''Run a function f with many arguments in parallel'''
+def add_split_jobs(pipeline, module_class, args, n_splits, name,
+                   pin_name="input", filename=None):
+    '''
+    Fans out the reading of a single large text file into n_splits jobs of
+    module_class, each of them reading a different split of the file through
+    its pin_name TextFilePin (see TextFilePin.set_split). The jobs receive
+    the same args and are named name/<split number>.
+    If the file is given, the ranges of the splits are computed here, so
+    that the jobs don't read the block table of a BGZF file each.
+    Returns the list of jobs
+    '''
+    if isinstance(name, basestring):
+        name = (name,)
+    ranges = split_ranges(filename, n_splits) if filename else \
+        [None] * n_splits
+    jobs = []
+    for i in xrange(n_splits):
+        job = module_class(*(tuple(name) + (str(i),)))
+        job.set_args(*args)
+        job[pin_name].set_split(i, n_splits, ranges[i])
+        pipeline.add_module(job)
+        jobs.append(job)
+    return jobs
+
+
+def add_reduction_tree(pipeline, sources, make_merge_job, fan_in=16,
+                       name="reduce"):
+    '''
+    Reduces the pins in sources through a tree of merge jobs, each of them
+    reading at most fan_in pins, so that no single job has to read all the
+    sources. Every level of the tree is added as a new stage of the pipeline.
+    make_merge_job(*name) must create a module with an "input" PinMultiplex
+    and an "output" pin (e.g. a MergeJob or a StreamMergeJob), and the
+    reduction must be associative, since it is also applied to partial
+    results.
+    Returns the root job, named name.
+    '''
+    if fan_in < 2:
+        raise ValueError("fan_in must be at least 2, got {0}".format(fan_in))
+    level = 0
+    while True:
+        groups = [sources[i:i + fan_in] for i in
+                  xrange(0, len(sources), fan_in)] or [[]]
+        pipeline.add_stage()
+        if len(groups) == 1:
+            root = make_merge_job(name)
+            for pin in groups[0]:
+                pin.connect_to(root['input'])
+            pipeline.add_module(root)
+            return root
+        sources = []
+        for i, group in enumerate(groups):
+            job = make_merge_job(name, "level{0}".format(level), str(i))
+            for pin in group:
+                pin.connect_to(job['input'])
+            pipeline.add_module(job)
+            sources.append(job['output'])
+        level += 1
+
+
+def create_map_reduce_pipeline(work_path, m, r, args_list, fan_in=None,
+                               combiner=None):
+    '''Run a function f with many arguments in parallel
+    combiner: if given, it is applied to the result of each map job before
+        writing it (e.g. CombineByKey()), to reduce the size of the
+        intermediate results
+    fan_in: if given, the results are reduced through a tree of jobs
+        that read at most fan_in results each (see add_reduction_tree).
+        r must then be associative'''
     p = Pipeline(work_path)
-    reduce_job = MergeJob("reduce")
-    reduce_job.set_args(r, [])
-    reduce_job['output'].connect_to(p['output'])
+    map_outputs = []
     for i, args in enumerate(args_list):
         map_job = SimpleJob("map", str(i))
-        map_job.set_args(m, args)
-        map_job['output'].connect_to(reduce_job['input'])
+        map_job.set_args(m, args, combiner)
+        map_outputs.append(map_job['output'])
         p.add_module(map_job)
-    p.add_stage()
-    p.add_module(reduce_job)
+
+    def make_reduce_job(*name):
+        reduce_job = MergeJob(*name)
+        reduce_job.set_args(r, [])
+        return reduce_job
+    reduce_job = add_reduction_tree(p, map_outputs, make_reduce_job,
+                                    fan_in or max(len(map_outputs), 1))
+    reduce_job['output'].connect_to(p['output'])
     return p
 
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from clutils.aux import mkdir_p
+
+
+def file_digest(filename, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def args_fingerprint(h, value):
+    '''
+    Adds to the hash h what pickling value leaves out: the source code of
+    the functions and classes in it (which are pickled by name) and the
+    size and modification time of the files that it names, looking into
+    lists, tuples and dictionaries
+    '''
+    import inspect
+    if isinstance(value, (list, tuple)):
+        for v in value:
+            args_fingerprint(h, v)
+    elif isinstance(value, dict):
+        for k, v in sorted(value.iteritems(), key=repr):
+            args_fingerprint(h, k)
+            args_fingerprint(h, v)
+    elif inspect.isfunction(value) or inspect.ismethod(value) or \
+            inspect.isclass(value):
+        try:
+            h.update(inspect.getsource(value))
+        except (IOError, TypeError):
+            pass
+    elif isinstance(value, basestring) and len(value) < 4096 and \
+            '\0' not in value and os.path.isfile(value):
+        st = os.stat(value)
+        h.update('{0}:{1}:{2!r}'.format(value, st.st_size, st.st_mtime))
+
+
+def module_key(module):
+    '''
+    Computes the key that identifies the result of a module: a hash of the
+    module class (its name and source code), its arguments (including the
+    source of the functions and the size and modification time of the files
+    among them, see args_fingerprint) and the contents of the pins it reads
+    from
+    '''
+    import inspect
+    h = hashlib.sha1()
+    cls = type(module)
+    h.update('{0}.{1}'.format(cls.__module__, cls.__name__))
+    try:
+        h.update(inspect.getsource(cls))
+    except (IOError, TypeError):
+        pass
+    h.update(pickle.dumps(module.args, 2))
+    args_fingerprint(h, module.args)
+    for pin_name in sorted(module.pins):
+        for source in module.pins[pin_name].sources():
+            for filename in source.files():
+                h.update(pin_name)
+                h.update(file_digest(filename))
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    '''
+    Stores the output pins of the modules indexed by module_key, so that a
+    module whose class, arguments and inputs did not change since a previous
+    run (in any work path) doesn't need to be run again.
+    The cache keeps at most max_size bytes (e.g. "100G"), evicting the least
+    recently used results.
+    Changes that module_key doesn't see return stale results: the code
+    called by the functions passed as arguments (only their own source is
+    hashed), the contents of directories named in the arguments, and files
+    modified without changing their size or modification time.
+    link: hard link the files instead of copying them. The linked files are
+        shared with the cache, so they must not be modified in place.
+    '''
+    def __init__(self, path, max_size=None, link=False):
+        from clutils.executors import parse_memory
+        self.path = os.path.abspath(path)
+        self.max_size = parse_memory(max_size)
+        self.link = link
+        mkdir_p(self.path)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _put_file(self, src, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+        if self.link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+
+    def fetch(self, module):
+        '''Copies the cached outputs of the module into its pins. Returns
+        whether they were found in the cache'''
+        key = module_key(module)
+        entry = self.entry_path(key)
+        if not os.path.isdir(entry):
+            return False
+        for pin_name, pin in module.pins.iteritems():
+            for filename in pin.files():
+                self._put_file(os.path.join(entry, pin_name,
+                                            os.path.basename(filename)),
+                               filename)
+        #touch the entry to keep track of the least recently used ones
+        os.utime(entry, None)
+        logging.info("{0}: CACHED ({1})".format(module, key))
+        return True
+
+    def store(self, module):
+        '''Adds the outputs of a finished module to the cache'''
+        key = module_key(module)
+        entry = self.entry_path(key)
+        if os.path.isdir(entry):
+            return
+        mkdir_p(os.path.dirname(entry))
+        tmp_entry = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            for pin_name, pin in module.pins.iteritems():
+                if not pin.files():
+                    continue
+                mkdir_p(os.path.join(tmp_entry, pin_name))
+                for filename in pin.files():
+                    self._put_file(filename, os.path.join(tmp_entry, pin_name,
+                                                os.path.basename(filename)))
+            with open(os.path.join(tmp_entry, 'info.pkl'), 'wb') as f:
+                pickle.dump({'module': repr(module), 'created': time.time()},
+                            f, 2)
+        except:
+            shutil.rmtree(tmp_entry, True)
+            raise
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            #another job stored the same result concurrently
+            shutil.rmtree(tmp_entry, True)
+        if self.max_size:
+            self.prune(self.max_size)
+
+    def entries(self):
+        '''Returns a list of (key, last_used, size, info) sorted from the most
+        recently used to the least one'''
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                entry = os.path.join(prefix_path, key)
+                if key.startswith('tmp'):
+                    continue
+                size = 0
+                for dirpath, _, filenames in os.walk(entry):
+                    for filename in filenames:
+                        size += os.path.getsize(os.path.join(dirpath, filename))
+                try:
+                    with open(os.path.join(entry, 'info.pkl'), 'rb') as f:
+                        info = pickle.load(f)
+                except IOError:
+                    info = {}
+                entries.append((key, os.path.getmtime(entry), size, info))
+        entries.sort(key=lambda e: e[1], reverse=True)
+        return entries
+
+    def prune(self, max_size=0):
+        '''Removes the least recently used entries until the cache takes at
+        most max_size bytes. Returns the number of removed entries'''
+        total = 0
+        removed = 0
+        for key, _, size, _ in self.entries():
+            total += size
+            if total > max_size:
+                shutil.rmtree(self.entry_path(key), True)
+                removed += 1
+        return removed
+
+
+def main():
+    from clutils.executors import parse_memory
+    parser = argparse.ArgumentParser(description=
+    '''Inspects and prunes a result cache''')
+    parser.add_argument('path', help='directory of the cache')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.add_parser('list', help='list the cached results')
+    prune_parser = subparsers.add_parser('prune', help='remove the least '
+        'recently used results')
+    prune_parser.add_argument('max_size', help='size to which the cache '
+        'is reduced (e.g. 10G). Use 0 to empty it')
+
+    args = parser.parse_args()
+
+    cache = ResultCache(args.path)
+    if args.action == 'list':
+        total = 0
+        for key, last_used, size, info in cache.entries():
+            total += size
+            print "{0}\t{1}\t{2}\t{3}".format(key,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)),
+                size, info.get('module', ''))
+        print "Total: {0} bytes".format(total)
+    elif args.action == 'prune':
+        print "Removed {0} entries".format(
+            cache.prune(parse_memory(args.max_size)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import io
+import os
+import struct
+
+#Decompression is done in-process. xz requires the backports.lzma package
+#in python 2 and zstd the zstandard package
+MAGIC_NUMBERS = [('\x1f\x8b', 'gzip'),
+                 ('BZh', 'bz2'),
+                 ('\xfd7zXZ\x00', 'xz'),
+                 ('\x28\xb5\x2f\xfd', 'zstd')]
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+
+def detect_compression(filename):
+    '''Returns the compression format of a file looking at its first bytes,
+    or None if it's not compressed'''
+    with open(filename, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def open_compressed(filename, compression='auto'):
+    '''
+    Opens a file for reading, decompressing it in-process.
+    compression: 'gzip', 'bz2', 'xz', 'zstd', None (not compressed) or
+        'auto' to detect it from the file contents
+    '''
+    if compression == 'auto':
+        compression = detect_compression(filename)
+    if compression is None:
+        return io.open(filename, 'rb', buffering=DEFAULT_BLOCK_SIZE)
+    elif compression == 'gzip':
+        import gzip
+        return gzip.GzipFile(filename, 'rb')
+    elif compression == 'bz2':
+        import bz2
+        return bz2.BZ2File(filename, 'rb', buffering=DEFAULT_BLOCK_SIZE)
+    elif compression == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma
+        return lzma.open(filename, 'rb')
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), read_size=DEFAULT_BLOCK_SIZE)
+    else:
+        raise ValueError("Unknown compression '{0}'".format(compression))
+
+
+def create_compressed(filename, compression=None,
+                      block_size=DEFAULT_BLOCK_SIZE):
+    '''Opens a file for writing, compressing it in-process with compression
+    (see open_compressed)'''
+    if compression is None:
+        return io.open(filename, 'wb', buffering=block_size)
+    elif compression == 'gzip':
+        import gzip
+        return gzip.GzipFile(filename, 'wb', compresslevel=6)
+    elif compression == 'bz2':
+        import bz2
+        return bz2.BZ2File(filename, 'wb', buffering=block_size)
+    elif compression == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma
+        return lzma.open(filename, 'wb')
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(
+            open(filename, 'wb'), write_size=block_size)
+    else:
+        raise ValueError("Unknown compression '{0}'".format(compression))
+
+
+def read_blocks(f, block_size=DEFAULT_BLOCK_SIZE):
+    '''Yields the (decompressed) contents of f in blocks of block_size bytes'''
+    try:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            yield block
+    finally:
+        f.close()
+
+
+def read_line_batches(f, block_size=DEFAULT_BLOCK_SIZE):
+    '''Yields lists with the lines (including the line ending) contained in
+    each block of f'''
+    rest = ''
+    for block in read_blocks(f, block_size):
+        data = rest + block
+        end = data.rfind('\n') + 1
+        if not end:
+            rest = data
+            continue
+        rest = data[end:]
+        yield io.BytesIO(data[:end]).readlines()
+    if rest:
+        yield [rest]
+
+
+def read_lines(f, block_size=DEFAULT_BLOCK_SIZE):
+    for lines in read_line_batches(f, block_size):
+        for line in lines:
+            yield line
+
+
+def bgzf_blocks(filename):
+    '''Returns a list with the (offset, uncompressed size) of each block of a
+    BGZF (block gzip) file. Raises ValueError if the file is not BGZF'''
+    blocks = []
+    with open(filename, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(12)
+            if not header:
+                break
+            if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+                raise ValueError("{0} is not a BGZF file".format(filename))
+            xlen, = struct.unpack('<H', header[10:12])
+            extra = f.read(xlen)
+            bsize = None
+            i = 0
+            while i + 4 <= len(extra):
+                slen, = struct.unpack('<H', extra[i + 2:i + 4])
+                if extra[i:i + 2] == 'BC' and slen == 2:
+                    bsize, = struct.unpack('<H', extra[i + 4:i + 6])
+                i += 4 + slen
+            if bsize is None:
+                raise ValueError("{0} is not a BGZF file".format(filename))
+            f.seek(offset + bsize + 1 - 4)
+            isize, = struct.unpack('<I', f.read(4))
+            blocks.append((offset, isize))
+            offset += bsize + 1
+    return blocks
+
+
+def split_ranges(filename, n, compression='auto'):
+    '''
+    Returns, for each of the n splits of a file, (raw_offset, offset, start,
+    end): the position of the file where its reading begins, the
+    uncompressed offset of that position and the range [start, end) of the
+    split (see read_line_range). Uncompressed files are split by byte
+    offsets and BGZF files by blocks, so the block table is read only once
+    for all the splits
+    '''
+    if compression == 'auto':
+        compression = detect_compression(filename)
+    ranges = []
+    if compression is None:
+        size = os.path.getsize(filename)
+        for i in xrange(n):
+            start = size * i // n
+            offset = max(start - 1, 0)
+            ranges.append((offset, offset, start, size * (i + 1) // n))
+    elif compression == 'gzip':
+        blocks = bgzf_blocks(filename)
+        cumulative = [0]
+        for _, isize in blocks:
+            cumulative.append(cumulative[-1] + isize)
+        for i in xrange(n):
+            first_block = len(blocks) * i // n
+            last_block = len(blocks) * (i + 1) // n
+            #start reading at the previous block to know whether the first
+            #line of the split starts exactly at the beginning of its first
+            #block
+            open_block = max(first_block - 1, 0)
+            raw_offset = blocks[open_block][0] if blocks else 0
+            ranges.append((raw_offset, cumulative[open_block],
+                           cumulative[first_block], cumulative[last_block]))
+    else:
+        raise ValueError("Only uncompressed and BGZF files can be split")
+    return ranges
+
+
+def open_split(filename, i, n, compression='auto', split_range=None):
+    '''
+    Prepares the reading of the i-th of n splits of a file.
+    split_range: the i-th range returned by split_ranges. Pass it when
+        there are many splits, so that each of them doesn't read the block
+        table of the whole file
+    Returns (f, offset, start, end), where f is the decompressed stream,
+    which begins at the uncompressed offset, and [start, end) is the range
+    of the split (see read_line_range)
+    '''
+    if compression == 'auto':
+        compression = detect_compression(filename)
+    if split_range is None:
+        split_range = split_ranges(filename, n, compression)[i]
+    raw_offset, offset, start, end = split_range
+    if compression is None:
+        f = open_compressed(filename, None)
+        f.seek(raw_offset)
+    elif compression == 'gzip':
+        import gzip
+        raw = open(filename, 'rb')
+        raw.seek(raw_offset)
+        f = gzip.GzipFile(fileobj=raw, mode='rb')
+    else:
+        raise ValueError("Only uncompressed and BGZF files can be split")
+    return f, offset, start, end
+
+
+def read_line_range(f, offset, start, end, block_size=DEFAULT_BLOCK_SIZE):
+    '''Yields the lines of f that begin in the byte range [start, end),
+    where offset is the position of the first byte of f (offset < start,
+    unless start is 0), so lines are never split between two ranges'''
+    pos = offset
+    try:
+        for line in read_lines(f, block_size):
+            if pos >= end:
+                break
+            if pos >= start:
+                yield line
+            pos += len(line)
+    finally:
+        f.close()
@@ -1,5 +1,9 @@
 import yaml
 import collections
+import fnmatch
+import os
+import re
+from clutils.aux import dict_flatten
 def nodenames(match_expr):
     import re
     nodes = ["compute-{0}-{1}".format(i,j) for i in [0,1] for j in
@@ -26,4 +30,54 @@ def replace_nodenames(d):
 def load_config(yml_file):
     config = yaml.load(file(yml_file))
     config = replace_nodenames(config)
-    return config
\ No newline at end of file
+    return config
+
+
+def pattern_specificity(pattern):
+    '''Sorting key that puts general patterns before more specific ones: the
+    more literal (non-wildcard) characters, the more specific'''
+    literal = re.sub(r'\[[^]]*\]|[*?]', '', pattern)
+    return len(literal), len(pattern)
+
+
+class ConfigMatcher(object):
+    '''
+    Configuration compiled for a pipeline. The keys of the configuration are
+    paths (with wildcards) relative to the pipeline work path, and the final
+    keys are the settings applied to the modules whose work path matches.
+    The patterns are compiled and sorted once, from the most general to the
+    most specific, so resolving the settings of a module only involves
+    matching its path against each compiled pattern
+    '''
+    def __init__(self, config, work_path):
+        #flat all keys into tuples
+        flattened_config = dict_flatten(config)
+        #the final keys in the config represent attributes of the modules
+        #so we un-flatten them
+        unflat_config = {}
+        for k,v in flattened_config.iteritems():
+            #transform the key into a path
+            nk = os.path.join(work_path,"/".join(k[:-1])) + '*'
+            if nk not in unflat_config:
+                unflat_config[nk] = {}
+            unflat_config[nk][k[-1]] = v
+        self.patterns = [(re.compile(fnmatch.translate(pattern)), pattern,
+                          unflat_config[pattern])
+                         for pattern in sorted(unflat_config,
+                                               key=pattern_specificity)]
+
+    def defines(self, setting):
+        '''Returns whether any pattern sets the given setting'''
+        return any(values.get(setting) is not None
+                   for _, _, values in self.patterns)
+
+    def settings(self, path):
+        '''Returns the settings that apply to the given module path'''
+        settings = {}
+        for regex, _, values in self.patterns:
+            if regex.match(path):
+                for k,v in values.iteritems():
+                    #can erase default configuration settings (not recommended)
+                    if v is not None:
+                        settings[k] = v
+        return settings
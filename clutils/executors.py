@@ -0,0 +1,465 @@
+import copy
+import logging
+import os
+import threading
+import time
+import uuid
+from abc import abstractmethod
+from collections import deque, defaultdict
+from functools import partial
+from pythongrid import process_jobs
+from clutils.aux import remove_claim, SupersededError
+
+
+def parse_memory(value):
+    '''Converts a SGE memory specification (e.g. "512M", "1.5G") into bytes.
+    Lowercase suffixes are powers of 1000 and uppercase ones powers of 1024,
+    as in SGE'''
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, long, float)):
+        return int(value)
+    value = value.strip()
+    multipliers = {'k': 1000, 'm': 1000 ** 2, 'g': 1000 ** 3,
+                   'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(float(value))
+
+
+def physical_memory():
+    '''Returns the total amount of memory of the node in bytes'''
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class Executor(object):
+    '''
+    Runs the jobs created by the pipeline. Subclasses must define submit,
+    which starts the execution of a job and returns a
+    concurrent.futures.Future that is resolved with the job once it has
+    finished
+    '''
+    #whether the jobs run on the same node as the pipeline
+    same_node = False
+
+    @abstractmethod
+    def submit(self, job):
+        raise NotImplementedError
+
+    def process_jobs(self, jobs):
+        '''Runs all the jobs and blocks until every one of them has finished'''
+        from concurrent.futures import wait
+        futures = [self.submit(job) for job in jobs]
+        #wait for all of them, so that a failure doesn't leave the rest of
+        #the stage running
+        wait(futures)
+        for future in futures:
+            future.result()
+        return jobs
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class GridExecutor(Executor):
+    '''
+    Runs the jobs through pythongrid, either on SGE or, if local is True,
+    one after another in the current process.
+    submit (used by the 'dag' schedule and RetryingExecutor) appends the
+    grid jobs to a single DRMAA session, and one thread polls their states
+    every poll_interval seconds and resolves the futures of the finished
+    ones with the job pythongrid stored in its output file
+    '''
+    def __init__(self, local=False, poll_interval=5):
+        self.local = local
+        self.same_node = local
+        self.poll_interval = poll_interval
+        #local jobs are run one after another, as in process_jobs
+        self.threads = None
+        #DRMAA allows a single session per process
+        self.session = None
+        self.running = {}
+        self.monitor = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def process_jobs(self, jobs):
+        return process_jobs(jobs, local=self.local)
+
+    def submit(self, job):
+        if self.local:
+            from concurrent.futures import ThreadPoolExecutor
+            with self.lock:
+                if self.threads is None:
+                    self.threads = ThreadPoolExecutor(1)
+            return self.threads.submit(lambda: process_jobs([job],
+                                                            local=True)[0])
+        from concurrent.futures import Future
+        from pythongrid import append_job_to_session, save
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self.lock:
+            if self.session is None:
+                import drmaa
+                self.session = drmaa.Session()
+                self.session.initialize()
+                self.stopped.clear()
+                self.monitor = threading.Thread(target=self._poll)
+                self.monitor.daemon = True
+                self.monitor.start()
+            save(job.inputfile, job)
+            jobid = append_job_to_session(self.session, job)
+            self.running[jobid] = (job, future)
+        return future
+
+    def _poll(self):
+        import drmaa
+        finished = (drmaa.JobState.DONE, drmaa.JobState.FAILED)
+        while not self.stopped.wait(self.poll_interval):
+            with self.lock:
+                jobids = list(self.running)
+            for jobid in jobids:
+                try:
+                    state = self.session.jobStatus(jobid)
+                except drmaa.errors.InvalidJobException:
+                    #SGE forgets about jobs some time after they finish
+                    state = drmaa.JobState.DONE
+                except drmaa.errors.DrmaaException, e:
+                    logging.warning("{0}: could not get the state of the "
+                                    "job ({1})".format(jobid, e))
+                    continue
+                if state not in finished:
+                    continue
+                with self.lock:
+                    job, future = self.running.pop(jobid)
+                self._collect(job, state == drmaa.JobState.FAILED)
+                future.set_result(job)
+
+    def _collect(self, job, failed):
+        '''Copies the results of a finished grid job into job.
+        As with process_jobs, failures are reported through job.ret'''
+        from pythongrid import load
+        if failed:
+            job.ret = RuntimeError("the grid job {0} failed".format(job.jobid))
+            return
+        try:
+            ret_job = load(job.outputfile)
+        except Exception, e:
+            job.ret = e
+            return
+        job.ret = ret_job.ret
+        job.exception = getattr(ret_job, 'exception', None)
+        if job.exception is not None:
+            job.ret = job.exception
+
+    def shutdown(self, wait=True):
+        if self.threads is not None:
+            self.threads.shutdown(wait)
+            self.threads = None
+        if self.session is None:
+            return
+        if wait:
+            while self.running:
+                time.sleep(self.poll_interval)
+        else:
+            import drmaa
+            with self.lock:
+                for jobid in self.running:
+                    try:
+                        self.session.control(
+                            jobid, drmaa.JobControlAction.TERMINATE)
+                    except drmaa.errors.DrmaaException:
+                        pass
+        self.stopped.set()
+        self.monitor.join()
+        with self.lock:
+            for job, future in self.running.values():
+                job.ret = RuntimeError("the executor was shut down")
+                future.set_result(job)
+            self.running.clear()
+            self.session.exit()
+            self.session = None
+
+
+def _execute(function, args, kwlist, memory_limit):
+    '''Runs a job inside a worker process, limiting its address space as
+    SGE does with h_vmem'''
+    import resource
+    if memory_limit:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+    try:
+        return function(*args, **kwlist)
+    finally:
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+class LocalPoolExecutor(Executor):
+    '''
+    Runs the jobs in parallel in a pool of processes on the local node.
+    The h_vmem setting of each job (see Pipeline.apply_config) is enforced
+    as a limit on its address space, and jobs are only started while the sum
+    of their h_vmem fits in max_memory (by default, the node memory)
+    '''
+    same_node = True
+
+    def __init__(self, max_workers=None, max_memory=None):
+        import multiprocessing
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.max_memory = parse_memory(max_memory) or physical_memory()
+        self.used_memory = 0
+        self.running = 0
+        self.queue = deque()
+        self.lock = threading.RLock()
+        self.pool = None
+
+    def submit(self, job):
+        from concurrent.futures import Future, ProcessPoolExecutor
+        future = Future()
+        memory = parse_memory(getattr(job, 'h_vmem', None))
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.max_workers)
+            self.queue.append((job, memory, future))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        with self.lock:
+            #jobs wait in the queue (where they can be cancelled) until a
+            #worker is free
+            while self.queue and self.running < self.max_workers:
+                job, memory, future = self.queue[0]
+                #a job that needs more than max_memory is run alone
+                reserved = min(memory or 0, self.max_memory)
+                if self.used_memory and \
+                        self.used_memory + reserved > self.max_memory:
+                    break
+                self.queue.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.used_memory += reserved
+                self.running += 1
+                inner = self.pool.submit(_execute, job.function, job.args,
+                                         getattr(job, 'kwlist', {}), memory)
+                inner.add_done_callback(partial(self._done, job, reserved,
+                                                future))
+
+    def _done(self, job, reserved, future, inner):
+        with self.lock:
+            self.used_memory -= reserved
+            self.running -= 1
+        e = inner.exception()
+        if isinstance(e, SupersededError):
+            logging.info("{0}: superseded by another copy".format(job.args[0]))
+            future.set_exception(e)
+        elif e is not None:
+            logging.error("{0}: FAILED ({1})".format(job.args[0], e))
+            future.set_exception(e)
+        else:
+            job.ret = inner.result()
+            future.set_result(job)
+        self._dispatch()
+
+    def shutdown(self, wait=True):
+        if self.pool is not None:
+            self.pool.shutdown(wait)
+            self.pool = None
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+def succeeded(job):
+    '''Returns whether the job, or all the modules of a packed job (see
+    Pipeline.run), finished successfully'''
+    ret = getattr(job, 'ret', None)
+    if isinstance(ret, list):
+        return all(r is True for r in ret)
+    return ret is True
+
+
+class _Task(object):
+    '''A job submitted to a RetryingExecutor and its running copies'''
+    def __init__(self, job, future):
+        self.job = job
+        self.future = future
+        self.module = job.args[0]
+        #packed jobs run a list of modules (see Pipeline.run)
+        self.modules = self.module if isinstance(self.module, list) \
+            else [self.module]
+        self.group = os.path.dirname(self.modules[0].work_path)
+        self.retries = int(getattr(job, 'retries', 0) or 0)
+        self.speculative = float(getattr(job, 'speculative', 0) or 0)
+        #inner future -> time at which the copy was seen running
+        self.copies = {}
+        self.speculated = False
+        self.finished = False
+        #copies running at once share a token, which changes on each retry
+        self.token = None
+        self.tokens = []
+
+    def new_attempt(self):
+        self.token = uuid.uuid4().hex
+        self.tokens.append(self.token)
+
+    def remove_claims(self):
+        for token in self.tokens:
+            for module in self.modules:
+                remove_claim(module.work_path, token)
+        self.tokens = []
+
+
+class RetryingExecutor(Executor):
+    '''
+    Wraps an executor to re-submit the jobs that fail, up to the number of
+    times given by their "retries" setting (e.g. {'*': {'retries': 2}}),
+    and to launch a second copy of the jobs that run longer than their
+    "speculative" setting times the median time of the modules of the same
+    stage directory (e.g. {'*': {'speculative': 3}}), once at least
+    min_completed of those have finished. The first copy that succeeds wins
+    and the other one is cancelled if it hasn't started yet. A copy that is
+    already running can't be stopped, so the copies claim the results of
+    the job as they write them (see clutils.aux.claimed_writes): the first
+    copy to put a file in place owns the outputs and stats of the job, and
+    the files of the other one are discarded.
+    Jobs that run in the current process (GridExecutor with local=True)
+    share the module objects, so they are retried but never duplicated
+    '''
+    def __init__(self, executor, min_completed=3, check_interval=1):
+        self.executor = executor
+        self.min_completed = min_completed
+        self.check_interval = check_interval
+        self.speculate = not getattr(executor, 'local', False)
+        self.same_node = executor.same_node
+        self.durations = defaultdict(list)
+        self.tasks = set()
+        #finished tasks whose losing copies are still running
+        self.losers = set()
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.monitor = None
+
+    def submit(self, job):
+        from concurrent.futures import Future
+        future = Future()
+        task = _Task(job, future)
+        future.add_done_callback(partial(self._cancelled, task))
+        with self.lock:
+            self._launch(task)
+            if self.speculate and task.speculative:
+                self.tasks.add(task)
+                if self.monitor is None:
+                    self.monitor = threading.Thread(target=self._monitor)
+                    self.monitor.daemon = True
+                    self.monitor.start()
+        return future
+
+    def _launch(self, task, speculative=False):
+        job = copy.copy(task.job)
+        if self.speculate and task.speculative:
+            if not speculative:
+                task.new_attempt()
+            job.kwlist = dict(job.kwlist or {},
+                              claim=(task.token, uuid.uuid4().hex))
+        inner = self.executor.submit(job)
+        task.copies[inner] = None
+        inner.add_done_callback(partial(self._done, task, time.time()))
+
+    def _done(self, task, submit_time, inner):
+        with self.lock:
+            start_time = task.copies.pop(inner, None) or submit_time
+            if task.finished or inner.cancelled():
+                if task.finished and not task.copies:
+                    task.remove_claims()
+                    self.losers.discard(task)
+                return
+            e = inner.exception()
+            if e is None:
+                task.job.ret = getattr(inner.result(), 'ret', None)
+            if e is None and succeeded(task.job):
+                self.durations[task.group].append(time.time() - start_time)
+                self._finish(task)
+                return
+            if task.copies:
+                #the other copy may still succeed
+                return
+            if task.retries > 0 and not self.stopped.is_set():
+                task.retries -= 1
+                logging.warning("{0}: FAILED ({1}), retrying".format(
+                    task.module, e or task.job.ret))
+                self._launch(task)
+                return
+            self._finish(task, e)
+
+    def _finish(self, task, exception=None):
+        task.finished = True
+        self.tasks.discard(task)
+        for inner in task.copies.keys():
+            if inner.cancel():
+                del task.copies[inner]
+        if task.copies:
+            self.losers.add(task)
+        else:
+            task.remove_claims()
+        if not task.future.set_running_or_notify_cancel():
+            return
+        if exception is not None:
+            task.future.set_exception(exception)
+        else:
+            task.future.set_result(task.job)
+
+    def _cancelled(self, task, future):
+        if future.cancelled():
+            with self.lock:
+                task.finished = True
+                self.tasks.discard(task)
+                for inner in task.copies:
+                    inner.cancel()
+
+    def _monitor(self):
+        while not self.stopped.wait(self.check_interval):
+            now = time.time()
+            with self.lock:
+                for task in list(self.tasks):
+                    for inner, start_time in task.copies.items():
+                        if start_time is None and inner.running():
+                            task.copies[inner] = now
+                    durations = self.durations[task.group]
+                    if task.speculated or \
+                            len(durations) < self.min_completed:
+                        continue
+                    started = [t for t in task.copies.values() if t]
+                    if not started:
+                        continue
+                    start_time = min(started)
+                    if now - start_time > task.speculative * median(durations):
+                        logging.warning("{0}: running for {1:.0f}s, launching "
+                                        "a speculative copy".format(
+                                            task.module, now - start_time))
+                        task.speculated = True
+                        self._launch(task, speculative=True)
+
+    def stop(self):
+        '''Stops watching for stragglers, without shutting down the wrapped
+        executor'''
+        self.stopped.set()
+        if self.monitor is not None:
+            self.monitor.join()
+            self.monitor = None
+
+    def shutdown(self, wait=True):
+        '''Shuts down the wrapped executor, without waiting for the losing
+        copies that are still running'''
+        self.stop()
+        with self.lock:
+            wait = wait and not self.losers
+        self.executor.shutdown(wait)
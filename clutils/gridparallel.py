@@ -14,10 +14,16 @@ from pythongrid import KybJob, process_jobs
 import logging
 logging.basicConfig(level=logging.INFO)
 import argparse
+import shutil
 import sys
 import os
 import yaml
-from clutils.pipeline import CommandLineJob, Pipeline
+from collections import deque
+from clutils.aux import mkdir_p
+from clutils.pipeline import Pipeline
+from clutils.building_blocks import CommandLineJob, BatchCommandLineJob, \
+    run_command, command_line
+from clutils.compressed import DEFAULT_BLOCK_SIZE
 
 
 def main():
@@ -26,6 +32,33 @@ def main():
     parser.add_argument('-n', '--name', default='gridparallel_logs')
     parser.add_argument('-c', '--config')
     parser.add_argument('-D', '--debug', action='store_true', default=False)
+    parser.add_argument('-b', '--batch-size', type=int, default=1,
+                        help='number of fillers run by each grid job')
+    parser.add_argument('--target-duration', type=float,
+                        help='seconds that each grid job should last. '
+                        'Sets the batch size from --task-duration')
+    parser.add_argument('--task-duration', type=float,
+                        help='estimated seconds that each filler takes')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='number of fillers run concurrently inside each '
+                        'grid job')
+    parser.add_argument('-z', '--compression',
+                        choices=['gzip', 'bz2', 'xz', 'zstd'],
+                        help='compress the output of each command')
+    parser.add_argument('--collect', metavar='FILE',
+                        help='concatenate the outputs of all the commands, in '
+                        'the order of the fillers, into FILE (- for stdout)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='run the commands on this machine instead of on '
+                        'the grid, at most JOBS at once. They start while the '
+                        'fillers are still being read')
+    parser.add_argument('--shell', action='store_true', default=None,
+                        help='run the commands through the shell (e.g. to use '
+                        'pipes in the arguments). This is the default on the '
+                        'grid')
+    parser.add_argument('--no-shell', dest='shell', action='store_false',
+                        help='pass the arguments to the command as they are, '
+                        'without a shell. This is the default with --jobs')
     parser.add_argument('command', help='command to be runned')
     parser.add_argument('arguments', help='arguments for the command', nargs='*')
 
@@ -36,58 +69,236 @@ def main():
     else:
         config = {}
     
-    execute_command_parallel(os.path.join(os.getcwd(),args.name), 
-                             args.command, args.arguments, config, args.debug)
+    batch_size = args.batch_size
+    if args.target_duration:
+        if not args.task_duration:
+            parser.error('--target-duration requires --task-duration')
+        batch_size = max(1, int(args.target_duration / args.task_duration))
 
-def execute_command(command, arguments, filler):
-    from subprocess import Popen, PIPE
+    work_path = os.path.join(os.getcwd(), args.name)
+    if args.shell is None:
+        args.shell = not args.jobs
+    if args.jobs:
+        if batch_size > 1:
+            parser.error('--jobs runs each filler separately, without batches')
+        failed = execute_command_local(work_path, args.command,
+                                       args.arguments, read_fillers(sys.stdin),
+                                       args.jobs, args.compression,
+                                       args.collect, args.shell)
+        if failed:
+            sys.exit(1)
+        return
+    failed = execute_command_parallel(work_path, args.command, args.arguments,
+                                      config, args.debug, batch_size,
+                                      args.threads, args.compression,
+                                      args.collect, args.shell)
+    if failed:
+        sys.exit(1)
+
+def read_fillers(f):
+    '''Yields the lines of f as soon as they are read (iterating over a
+    file in python 2 waits until its read-ahead buffer is full)'''
+    for line in iter(f.readline, ''):
+        yield line.strip()
+
+def execute_command(command, arguments, filler, output_filename,
+                    error_filename=None, compression=None, shell=False):
     command = command.replace('{}', filler)
     arguments = [arg.replace('{}', filler) for arg in arguments]
-    #FIXME: does it make any sense to pipe the stdout?
-    f = Popen(" ".join([command] + arguments), stdout=PIPE, shell=True)
-    for line in f.stdout:
-        print line.strip()
-    return f.wait()
+    return run_command(command_line(command, arguments, shell),
+                       output_filename, error_filename, compression)
 
-def make_jobs(work_path, command, arguments, fillers):
+def make_jobs(work_path, command, arguments, fillers, batch_size=1,
+              threads=1, compression=None, shell=False):
     """
-    creates a list of KybJob objects,
-    which carry all information needed
-    for a function to be executed on SGE:
-    - function object
-    - arguments
-    - settings
+    creates a list of modules,
+    each of which runs the command for batch_size fillers
     """
 
     # create empty job vector
     jobs=[]
 
     # create job objects
-    for filler in fillers:
-        command_filler = command.replace('{}', filler)
-        arguments_filler = [arg.replace('{}', filler) for arg in arguments]
-        modulename = filler
-        job = CommandLineJob(work_path, modulename,
-                             command_filler, arguments_filler) 
-        jobs.append(job)
-        
+    if batch_size == 1:
+        for i, filler in enumerate(fillers):
+            command_filler = command.replace('{}', filler)
+            arguments_filler = [arg.replace('{}', filler) for arg in arguments]
+            #named by index, as fillers can be paths or contain any character
+            job = CommandLineJob(str(i))
+            job.set_args(command_filler, arguments_filler, compression,
+                         shell)
+            jobs.append(job)
+    else:
+        for i in xrange(0, len(fillers), batch_size):
+            commands = []
+            for j, filler in enumerate(fillers[i:i + batch_size], i):
+                commands.append((str(j), command.replace('{}', filler),
+                                 [arg.replace('{}', filler)
+                                  for arg in arguments]))
+            job = BatchCommandLineJob("batch{0}".format(i // batch_size))
+            job.set_args(commands, threads, compression, shell)
+            jobs.append(job)
 
     return jobs
 
 
+def output_filenames(jobs):
+    '''Returns the output file of each filler, in order'''
+    filenames = []
+    for job in jobs:
+        if isinstance(job, BatchCommandLineJob):
+            filenames.extend(job.log_filenames())
+        else:
+            filenames.append(job['output'].filename)
+    return filenames
+
+
+def collect_outputs(filenames, output):
+    '''Concatenates the files into the output file object. They are copied
+    in large blocks as they are: compressed outputs are not decompressed,
+    since the concatenation of compressed streams is a valid compressed
+    stream for all the supported formats'''
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            #the command didn't run
+            continue
+        with open(filename, 'rb') as f:
+            shutil.copyfileobj(f, output, DEFAULT_BLOCK_SIZE)
+
+
+def local_output_filename(work_path, i):
+    #a thousand fillers per directory
+    return os.path.join(work_path, str(i // 1000), '{0}.log'.format(i))
+
+
+def execute_command_local(work_path, command, arguments, fillers, n_jobs,
+                          compression=None, collect=None, shell=False):
+    """
+    runs the command for each filler on this machine, at most n_jobs at
+    once. The fillers can be a stream: they are run as they are read. The
+    standard output of the i-th filler is written to
+    work_path/<i / 1000>/<i>.log and its standard error to <i>.err.
+    Returns the number of commands that failed
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    def run(i, filler):
+        filename = local_output_filename(work_path, i)
+        mkdir_p(os.path.dirname(filename))
+        return execute_command(command, arguments, filler, filename,
+                               filename[:-len('.log')] + '.err', compression,
+                               shell)
+
+    output = None
+    if collect == '-':
+        output = sys.stdout
+    elif collect:
+        output = open(collect, 'wb')
+    pool = ThreadPoolExecutor(n_jobs)
+    #the commands in filler order, which are reported (and collected) in
+    #that order as soon as they finish
+    submitted = deque()
+    running = set()
+    failed = 0
+    try:
+        for i, filler in enumerate(fillers):
+            while len(running) >= n_jobs:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+            future = pool.submit(run, i, filler)
+            running.add(future)
+            submitted.append((i, filler, future))
+            while submitted and submitted[0][2].done() or \
+                    len(submitted) > 100 * n_jobs:
+                failed += report_local(work_path, output,
+                                       *submitted.popleft())
+        while submitted:
+            failed += report_local(work_path, output, *submitted.popleft())
+    finally:
+        pool.shutdown()
+        if output is not None and output is not sys.stdout:
+            output.close()
+    if failed:
+        logging.error("{0} commands failed".format(failed))
+    return failed
 
 
-def execute_command_parallel(work_path, command, arguments, config, debug):
+def report_local(work_path, output, i, filler, future):
+    '''Waits for the command of a filler, logs its exit code if it failed
+    and copies its output into output. Returns whether it failed'''
+    filename = local_output_filename(work_path, i)
+    try:
+        exit_code = future.result()
+    except EnvironmentError, e:
+        #e.g. the executable doesn't exist
+        logging.warning("{0}: could not run the command ({1})".format(filler,
+                                                                      e))
+        return True
+    if exit_code != 0:
+        logging.warning("{0}: exit code {1} (output in {2})".format(
+            filler, exit_code, filename))
+    if output is not None:
+        collect_outputs([filename], output)
+    return exit_code != 0
+
+
+def execute_command_parallel(work_path, command, arguments, config, debug,
+                             batch_size=1, threads=1, compression=None,
+                             collect=None, shell=False):
     """
-    run a set of jobs on cluster
+    run a set of jobs on cluster.
+    With collect, the outputs are concatenated by the driver once all the
+    jobs have finished. The jobs run on other nodes, so the driver reads
+    each output file once (over NFS), in large blocks and without
+    decompressing it. It doesn't read the log files of pythongrid.
+    Returns the number of commands that failed
     """
 
-    fillers = [l.strip() for l in sys.stdin]
+    fillers = list(read_fillers(sys.stdin))
 
     pl = Pipeline(work_path)    
-    functionJobs = make_jobs(work_path, command, arguments, fillers)
+    functionJobs = make_jobs(work_path, command, arguments, fillers,
+                             batch_size, threads, compression, shell)
     pl.add_stage(*functionJobs)
-    pl.run(debug, False, config)
+    failed_jobs = set()
+    pl.status_listeners.append(lambda module, status: status == 'failed' and
+                               failed_jobs.add(module))
+    try:
+        pl.run(debug, False, config)
+    except Exception:
+        #the failed commands are reported below
+        if not failed_jobs:
+            raise
+    failed = 0
+    for i, job in enumerate(functionJobs):
+        if job not in failed_jobs:
+            continue
+        if batch_size == 1:
+            failed += 1
+            logging.warning("{0}: failed (output in {1})".format(fillers[i],
+                                                        job.work_path))
+            continue
+        #report the exit code of each filler
+        exit_codes = job['exit_codes'].read() \
+            if job['exit_codes'].file_exists() else {}
+        for j, _, _ in job.args[0]:
+            if exit_codes.get(j) == 0:
+                continue
+            failed += 1
+            if j not in exit_codes:
+                logging.warning("{0}: failed (output in {1})".format(
+                    fillers[int(j)], job.work_path))
+                continue
+            logging.warning("{0}: exit code {1} (output in {2})".format(
+                fillers[int(j)], exit_codes[j],
+                os.path.join(job.work_path, '{0}.log'.format(j))))
+    if failed:
+        logging.error("{0} commands failed".format(failed))
+    if collect == '-':
+        collect_outputs(output_filenames(functionJobs), sys.stdout)
+    elif collect:
+        with open(collect, 'wb') as f:
+            collect_outputs(output_filenames(functionJobs), f)
+    return failed
 
 #    for job in processedFunctionJobs:
 #        with open(job.log_stdout_fn) as f:
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import time
+
+
+def fingerprint(filename):
+    '''Cheap checksum of an output file: its size and modification time'''
+    st = os.stat(filename)
+    return [st.st_size, int(st.st_mtime)]
+
+
+class StateManifest(object):
+    '''
+    Append-only journal, stored in the pipeline work path, of the modules
+    that finished (with the fingerprints of their output files) or failed.
+    It allows resuming a pipeline with a single read of a local file instead
+    of checking the outputs of every module on the file system
+    '''
+    def __init__(self, work_path, filename='state.journal'):
+        self.work_path = work_path
+        self.filename = os.path.join(work_path, filename)
+        self.completed = {}
+        self.failed = set()
+        self.exists = os.path.isfile(self.filename)
+        if self.exists:
+            self.load()
+
+    def load(self):
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #a record that was being written when the driver died
+                    continue
+                path = record['module']
+                if record['status'] == 'done':
+                    self.completed[path] = record['files']
+                    self.failed.discard(path)
+                else:
+                    self.completed.pop(path, None)
+                    self.failed.add(path)
+
+    def _key(self, module):
+        return os.path.relpath(module.work_path, self.work_path)
+
+    def _append(self, *records):
+        now = time.time()
+        with open(self.filename, 'a') as f:
+            for record in records:
+                record['time'] = now
+                f.write(json.dumps(record) + '\n')
+        self.exists = True
+
+    def _done_record(self, module):
+        files = {}
+        for pin in module.pins.itervalues():
+            for filename in pin.files():
+                if os.path.isfile(filename):
+                    files[os.path.relpath(filename, self.work_path)] = \
+                        fingerprint(filename)
+        key = self._key(module)
+        self.completed[key] = files
+        self.failed.discard(key)
+        return {'module': key, 'status': 'done', 'files': files}
+
+    def record_done(self, *modules):
+        '''Records the modules as finished, with a single write'''
+        if modules:
+            self._append(*[self._done_record(m) for m in modules])
+
+    def record_failed(self, module):
+        key = self._key(module)
+        self.completed.pop(key, None)
+        self.failed.add(key)
+        self._append({'module': key, 'status': 'failed'})
+
+    def finished(self, module, verify=False):
+        '''Returns whether the module was recorded as finished. If verify is
+        True, its output files must also be unchanged'''
+        files = self.completed.get(self._key(module))
+        if files is None:
+            return False
+        if verify:
+            for filename, expected in files.iteritems():
+                try:
+                    if fingerprint(os.path.join(self.work_path,
+                                                filename)) != expected:
+                        return False
+                except OSError:
+                    return False
+        return True
+
+    def log_summary(self):
+        logging.info("Resuming from {0}: {1} modules finished, {2} failed"
+                     .format(self.filename, len(self.completed),
+                             len(self.failed)))
@@ -1,18 +1,21 @@
-import fileinput
+import hashlib
+import json
 import logging
+import mmap
 import os
-from collections import MutableMapping
-from clutils.aux import mkdir_p
+import socket
+import struct
+import zlib
+from itertools import islice
+from collections import MutableMapping, deque
+from clutils.aux import mkdir_p, temp_filename, atomic_open, commit_file
 from clutils.serialization import PklSerializer
+from clutils.compressed import open_compressed, read_blocks, \
+    read_line_batches, read_lines, open_split, read_line_range, \
+    DEFAULT_BLOCK_SIZE
+import cPickle as pickle
 
 
-def gziplines(fname):
-    from subprocess import Popen, PIPE
-    f = Popen(['zcat' ] + [fname], stdout=PIPE)
-    for line in f.stdout:
-        yield line
-        
-
 class Pin(object):
     def __init__(self, name):
         super(Pin, self).__init__()
@@ -31,10 +34,32 @@ class Pin(object):
     def connect_to(self, ot):
         ot.put_source(self)
 
+    def sources(self):
+        '''Returns the list of pins from which this pin reads'''
+        if self.source is not None:
+            return [self.source]
+        return []
+
+    def files(self):
+        '''Returns the list of files in which this pin stores its values'''
+        return []
+
+    def bytes_written(self):
+        return sum(os.path.getsize(f) for f in self.files()
+                   if os.path.isfile(f))
+
+    def bytes_read(self):
+        return sum(source.bytes_written() for source in self.sources())
+
     def read(self):
         if self.source:
             return self.source.read()
 
+    def set_local(self, local):
+        '''Called by the pipeline before running the module, telling whether
+        all the modules run on the node of the pipeline'''
+        pass
+
     def dispose(self):
         '''Destroy the intermediate values of the pin'''
         #FIXME: some reference counting mechanism might be required
@@ -57,6 +82,10 @@ class OutputPin(Pin):
         self.output_path = os.path.join(work_path, self.name)
         mkdir_p(self.output_path)
         
+def _read_pin(pin):
+    return pin.read()
+
+
 class PinMultiplex(Pin):
     '''
     Allows to connect many pins to itself
@@ -76,9 +105,48 @@ class PinMultiplex(Pin):
     def append(self, pin):
         self.pins.append(pin)
 
+    def sources(self):
+        return list(self.pins)
+
     def read(self):
         for pin in self.pins:
             yield pin.read()
+
+    def read_prefetch(self, prefetch=4, workers=None, processes=False,
+                      ordered=True):
+        '''
+        Reads the connected pins like read, but loads and deserializes the
+        next prefetch pins in a pool of workers threads (or processes, which
+        requires the values to be picklable) while the caller processes the
+        current one. At most prefetch values are kept in memory besides the
+        current one.
+        ordered: if False, the values are yielded as soon as they are loaded
+            instead of in the order in which the pins were connected, which
+            is faster when the order doesn't matter (e.g. summing counts)
+        '''
+        from concurrent.futures import ThreadPoolExecutor, \
+            ProcessPoolExecutor, wait, FIRST_COMPLETED
+        pool_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        pool = pool_type(workers or prefetch)
+        pins = iter(self.pins)
+        pending = deque(pool.submit(_read_pin, pin)
+                        for pin in islice(pins, prefetch))
+        try:
+            while pending:
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    future = done.pop()
+                    pending.remove(future)
+                value = future.result()
+                for pin in islice(pins, 1):
+                    pending.append(pool.submit(_read_pin, pin))
+                yield value
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
     
     def file_exists(self):
         for pin in self.pins:
@@ -107,6 +175,9 @@ class ScalarPin(OutputPin):
 
     def file_exists(self):
         return self.serializer.file_exists()
+
+    def files(self):
+        return [self.serializer.filename]
         
 class DictionaryPin(OutputPin, MutableMapping):
     def __init__(self, name, dict_class=dict, serializer_type=PklSerializer):
@@ -148,31 +219,250 @@ class DictionaryPin(OutputPin, MutableMapping):
     def file_exists(self):
         return self.serializer.file_exists()
 
+    def files(self):
+        return [self.serializer.filename]
+
+
+class RecordStreamPin(OutputPin):
+    '''
+    Output pin for sequences of records that don't fit in memory. The
+    records are appended with write and stored on disk in compressed chunks
+    of chunk_size records. Reading the pin yields the records lazily, one
+    chunk at a time.
+    '''
+    frame_header = struct.Struct('<I')
+
+    def __init__(self, name, chunk_size=10000, compresslevel=6):
+        super(RecordStreamPin, self).__init__(name)
+        self.chunk_size = chunk_size
+        self.compresslevel = compresslevel
+
+    def initialize(self, work_path):
+        super(RecordStreamPin, self).initialize(work_path)
+        self.filename = os.path.join(self.output_path,
+                                     '{0}.rec'.format(self.name))
+        self.buffer = []
+        self.f = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['f'] = None
+        return state
+
+    def write(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self.f is None:
+            #written to a temporary file that replaces the output on close
+            self.f = open(temp_filename(self.filename), 'wb')
+        if self.buffer:
+            data = zlib.compress(pickle.dumps(self.buffer, 2),
+                                 self.compresslevel)
+            self.f.write(self.frame_header.pack(len(data)))
+            self.f.write(data)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        commit_file(self.f.name, self.filename)
+        self.f = None
+
+    def __iter__(self):
+        return self.read()
+
+    def read(self):
+        if self.source is not None:
+            return self.source.read()
+        return self.read_records()
+
+    def read_chunks(self):
+        '''Yields the lists of records as they were stored'''
+        with open(self.filename, 'rb') as f:
+            while True:
+                header = f.read(self.frame_header.size)
+                if not header:
+                    break
+                size, = self.frame_header.unpack(header)
+                yield pickle.loads(zlib.decompress(f.read(size)))
+
+    def read_records(self):
+        for chunk in self.read_chunks():
+            for record in chunk:
+                yield record
+
+    def file_exists(self):
+        return os.path.isfile(self.filename)
+
+    def files(self):
+        return [self.filename]
+
+
+class SharedMemoryPin(OutputPin):
+    '''
+    Output pin for NumPy arrays and other buffer objects (e.g. str or
+    bytearray) that, when all the modules run on the same node (debug mode
+    or a LocalPoolExecutor), is stored in shared memory (shm_path) instead of
+    the work path. Readers map it without copying: arrays are read as
+    read-only memory-mapped arrays and other buffers as mmap objects. Other
+    values are pickled. When the jobs may run on other nodes, the value is
+    stored in the work path as with a ScalarPin.
+    The pipeline disposes the shared memory once all the modules that read
+    it have finished. If the pin is only read by the pipeline pins, it's
+    kept until Pipeline.dispose is called
+    '''
+    def __init__(self, name, shm_path='/dev/shm'):
+        super(SharedMemoryPin, self).__init__(name)
+        self.shm_path = shm_path
+        self.local = False
+
+    def initialize(self, work_path):
+        super(SharedMemoryPin, self).initialize(work_path)
+        #describes where and how the value was stored
+        self.info_filename = os.path.join(self.output_path,
+                                          '{0}.shm.json'.format(self.name))
+        key = hashlib.sha1(os.path.abspath(self.output_path)).hexdigest()
+        self.shm_filename = os.path.join(self.shm_path, 'clutils-{0}-{1}'
+                                         .format(key[:16], self.name))
+        self.disk_filename = os.path.join(self.output_path, self.name)
+
+    def set_local(self, local):
+        self.local = local
+
+    def data_filename(self):
+        return self.shm_filename if self.local else self.disk_filename
+
+    def write(self, data):
+        try:
+            import numpy as np
+            is_array = isinstance(data, np.ndarray) and \
+                not data.dtype.hasobject
+        except ImportError:
+            is_array = False
+        filename = self.data_filename()
+        with atomic_open(filename, 'wb') as f:
+            if is_array:
+                kind = 'npy'
+                np.save(f, np.ascontiguousarray(data))
+            elif isinstance(data, (str, bytearray, buffer, memoryview)):
+                kind = 'buffer'
+                f.write(data)
+            else:
+                kind = 'pickle'
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        with atomic_open(self.info_filename, 'w') as f:
+            json.dump({'kind': kind, 'filename': filename,
+                       'host': socket.gethostname(), 'shared': self.local}, f)
+
+    def read(self):
+        if self.source is not None:
+            return self.source.read()
+        with open(self.info_filename) as f:
+            info = json.load(f)
+        if info['shared'] and info['host'] != socket.gethostname():
+            raise IOError("{0} is in the shared memory of {1}. Modules that "
+                          "run on other nodes can't read it".format(
+                              info['filename'], info['host']))
+        if info['kind'] == 'npy':
+            import numpy as np
+            return np.load(info['filename'], mmap_mode='r')
+        with open(info['filename'], 'rb') as f:
+            if info['kind'] == 'buffer':
+                if not os.fstat(f.fileno()).st_size:
+                    return ''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return pickle.load(f)
+
+    def dispose(self):
+        if os.path.isfile(self.shm_filename):
+            os.remove(self.shm_filename)
+
+    def file_exists(self):
+        if not os.path.isfile(self.info_filename):
+            return False
+        with open(self.info_filename) as f:
+            return os.path.isfile(json.load(f)['filename'])
+
+    def files(self):
+        return [self.info_filename, self.data_filename()]
+
 
 class TextFilePin(Pin):
     def __init__(self, name, ):
         super(TextFilePin, self).__init__(name)
         self.closed = True
+        self.split = None
+
+    def set_split(self, i, n, split_range=None):
+        '''Makes the pin read only the lines of the i-th of n splits of the
+        file (see clutils.compressed.open_split)'''
+        self.split = (i, n, split_range)
         
     
-    def open(self, filename, gzip=False):
-        '''Opens the pin for reading'''
+    def open(self, filename, gzip=False, compression='auto',
+             block_size=DEFAULT_BLOCK_SIZE):
+        '''Opens the pin for reading
+        compression: the compression of the file ('gzip', 'bz2', 'xz',
+            'zstd' or None). By default, it's detected from the file contents.
+            gzip=True is the same as compression='gzip'
+        block_size: number of bytes read (and decompressed) at once'''
         self.filename = filename
         self.gzip = gzip
+        self.compression = 'gzip' if gzip else compression
+        self.block_size = block_size
         self.closed = False
 
-    def read(self):
+    def _open_file(self):
         if self.closed:
             raise RuntimeError("Cannot read closed TextFilePin. Please, call 'open' first")
-        if self.gzip:
-            return gziplines(self.filename)
-        else:
-            return fileinput.FileInput(self.filename)
+        return open_compressed(self.filename, self.compression)
+
+    def read(self):
+        '''Returns an iterator over the lines of the file'''
+        if self.split:
+            if self.closed:
+                raise RuntimeError("Cannot read closed TextFilePin. Please, call 'open' first")
+            i, n, split_range = self.split
+            f, offset, start, end = open_split(self.filename, i, n,
+                                               self.compression, split_range)
+            return read_line_range(f, offset, start, end, self.block_size)
+        return read_lines(self._open_file(), self.block_size)
+
+    def read_batches(self, batch_size=10000):
+        '''Returns an iterator over lists of consecutive lines of the file
+        (of batch_size lines when reading a split)'''
+        if self.split:
+            lines = self.read()
+            return iter(lambda: list(islice(lines, batch_size)), [])
+        return read_line_batches(self._open_file(), self.block_size)
+
+    def read_blocks(self):
+        '''Returns an iterator over the raw (decompressed) blocks of bytes of
+        the file'''
+        if self.split:
+            raise RuntimeError("Cannot read raw blocks of a split")
+        return read_blocks(self._open_file(), self.block_size)
+
+    def bytes_read(self):
+        if self.closed:
+            return 0
+        size = os.path.getsize(self.filename)
+        if self.split:
+            return size // self.split[1]
+        return size
         
     def close(self):
         try:
             del(self.filename)
             del(self.gzip)
+            del(self.compression)
         except AttributeError:
             pass
         self.closed=True
@@ -181,3 +471,27 @@ class TextFilePin(Pin):
         #This is for output pins, so we don't really care here
         return True
 
+
+class TextOutputPin(TextFilePin):
+    '''
+    TextFilePin over <work_path>/<name>.txt, a text file written by its own
+    module (e.g. the output of a CommandLineJob), so that the following
+    modules can read its lines. The file can be compressed, which is
+    detected when reading
+    '''
+    def initialize(self, work_path):
+        self.open(os.path.join(work_path, '{0}.txt'.format(self.name)))
+
+    def close(self):
+        #it stays open for the modules that read it
+        pass
+
+    def bytes_read(self):
+        return 0
+
+    def file_exists(self):
+        return os.path.isfile(self.filename)
+
+    def files(self):
+        return [self.filename]
+
@@ -1,13 +1,27 @@
-from pythongrid import KybJob, process_jobs
+from pythongrid import KybJob
 import os
-import fnmatch
 import logging
-from aux import mkdir_p, dict_merge, dict_flatten
+from aux import mkdir_p, dict_merge, deferred_mkdir, mkdirs_parallel, \
+    claimed_writes, SupersededError
 import contextlib
+import threading
 import time
-from clutils.pins import PinMultiplex
+from clutils.pins import PinMultiplex, SharedMemoryPin
+from clutils.executors import GridExecutor, RetryingExecutor, parse_memory
+from clutils.resources import ResourceEstimator, ESTIMATED_SETTINGS, \
+    parse_time, format_time
+from clutils.report import save_stats, MODULE_STATS_FILENAME, \
+    PIPELINE_STATS_FILENAME
+from clutils.profiling import profiled
+from clutils.config_loader import ConfigMatcher
+from clutils.manifest import StateManifest
+from clutils.broadcast import Broadcast, resolve
 from abc import abstractmethod
 
+#configuration settings that are passed to run_clmodule instead of being
+#job settings for the grid engine
+RUN_OPTIONS = ('profile',)
+
 
 class BaseModule(object):
     def __init__(self, pins = None):
@@ -71,7 +85,7 @@ class JobModule(BaseModule):
             self.work_path = os.path.join(work_path, os.path.join(*self.name))
         mkdir_p(self.work_path)
         super(JobModule, self).initialize(self.work_path)
-        logging.info("Job Initialized at {0}".format(self.work_path))
+        logging.debug("Job Initialized at {0}".format(self.work_path))
                 
     def set_args(self, *args):
         self.args = args
@@ -108,11 +122,16 @@ class JobModule(BaseModule):
             pin.finalize()
 
 
+class PipelineCancelled(Exception):
+    pass
+
+
 class Pipeline(BaseModule):
     def __init__(self, work_path):
         mkdir_p(work_path)
         self.stages = []
         self.ctx_mgrs = []
+        self.status_listeners = []
         self.work_path = work_path
         super(Pipeline, self).__init__()
     
@@ -131,44 +150,90 @@ class Pipeline(BaseModule):
             self.add_stage()
         self.stages[-1].append(module)
 
+    def broadcast(self, obj):
+        '''
+        Stores an object that is shared by many modules once in the work path
+        and returns a handle to it, which can be passed to set_args instead
+        of the object. Each job then only carries the handle, and loads the
+        object when it starts
+        '''
+        return Broadcast.create(obj, os.path.join(self.work_path,
+                                                  'broadcast'))
+
     def add_context_mgr(self, ctx_mgr):
         self.ctx_mgrs.append(ctx_mgr)
         
     
     def apply_config(self, config, module, job):
-        #flat all keys into tuples
-        flattened_config = dict_flatten(config)
-        #the final keys in the config represent attributes of the modules
-        #so we un-flatten them
-        unflat_config = {}
-        for k,v in flattened_config.iteritems():
-            #transform the key into a path
-            nk = os.path.join(self.work_path,"/".join(k[:-1])) + '*'
-            if nk not in unflat_config:
-                unflat_config[nk] = {}
-            unflat_config[nk][k[-1]] = v
-        #apply from more general to more specific
-        config_order = sorted(unflat_config.keys(), cmp=lambda a,b: 
-            1 if fnmatch.fnmatch(a,b) else -1 if fnmatch.fnmatch(b,a) else 0)
-        #apply configuration
-        for config_k in config_order:
-            if fnmatch.fnmatch(module.work_path, config_k):
-                logging.debug('Applying config {0} to job {1}'.format(
-                            unflat_config[config_k], module))
-                for k,v in unflat_config[config_k].iteritems():
-                    #can erase default configuration settings (not recommended)
-                    if v is not None:
-                        setattr(job, k, v)
+        '''Sets the settings of the configuration that match the module as
+        attributes of the job. config can be a dictionary or a ConfigMatcher
+        (compiling it once is much faster when there are many modules)'''
+        if not isinstance(config, ConfigMatcher):
+            config = ConfigMatcher(config, self.work_path)
+        settings = config.settings(module.work_path)
+        logging.debug('Applying config {0} to job {1}'.format(settings, module))
+        for k,v in settings.iteritems():
+            setattr(job, k, v)
 
     def run(self, debug=False, resume=False, config=None, pythonpathdir=None,
-        init_stage=0):
-        #Initialize modules
+        init_stage=0, schedule='stages', executor=None, cache=None,
+        cancel_event=None, resources=False):
+        '''
+        executor: the Executor that runs the jobs (see clutils.executors).
+            By default, jobs are sent to SGE, or run one after another in
+            the current process if debug is True. An executor that is
+            given is not shut down, so it can be shared by many pipelines.
+            If the configuration sets "retries" or "speculative" for some
+            modules, the executor is wrapped in a RetryingExecutor
+        cache: a ResultCache (see clutils.cache) from which to take the
+            outputs of the modules that were already run with the same
+            arguments and inputs, and in which to store the new ones
+        resume: don't re-run the modules that already finished. They are
+            looked up in the state manifest of the work path (see
+            clutils.manifest) or, if there is none, with their finished
+            method. If resume is 'verify', the output files recorded in the
+            manifest must also be unchanged
+        schedule: 'stages' waits for every job of a stage before starting the
+            next one. 'dag' starts every module as soon as the modules it
+            is connected to have finished (see dependencies)
+        cancel_event: a threading.Event which, when set, stops the pipeline
+            from submitting more jobs and raises PipelineCancelled (see
+            submit)
+        resources: a ResourceEstimator (see clutils.resources) that sets the
+            h_vmem and h_cpu of the modules that were already run from their
+            measured peak memory and time, unless they are set in config.
+            True uses the default one. It is disabled by default. When the
+            jobs run on the grid with the 'stages' schedule, the short
+            modules are packed together in the same jobs
+        '''
+        self.cancel_event = cancel_event or threading.Event()
+        if resources is True:
+            resources = ResourceEstimator()
+        if resources:
+            resources.load(self.work_path)
+        self.resources = resources
+        #Initialize modules. Their directories are only created when they
+        #are about to be run (see prepare)
+        self.pending_dirs = {}
         for stage in self.stages:
                 for module in stage:
-                    module.initialize(self.work_path)
+                    with deferred_mkdir() as dirs:
+                        module.initialize(self.work_path)
+                    self.pending_dirs[module] = dirs
         logging.debug("Initialization Finished")
+        self.finished_modules = set()
+        self.shared_pins = self.shared_memory_consumers()
+        for stage in self.stages:
+            for module in stage:
+                self.set_status(module, 'pending')
+        self.manifest = StateManifest(self.work_path)
+        #only trust the manifest if it was there before this run
+        self.use_manifest = self.manifest.exists
+        if resume and self.use_manifest:
+            self.manifest.log_summary()
         #default configuration
         default_config = {'*': {'h_cpu': '1:0:0', 'h_vmem': '1G'}}
+        user_config = None
         if not config:
             logging.debug("Using default configuration")
             config = default_config
@@ -178,6 +243,8 @@ class Pipeline(BaseModule):
             if all(isinstance(v, basestring) for v in config.values()):
                 logging.debug("Using same configuration for all modules")
                 config = {'*': config}
+            #the estimated resources don't override the user settings
+            user_config = ConfigMatcher(config, self.work_path)
             config = dict_merge(config, default_config)
             logging.debug("Merged user-provided configuration: {0}".format(config))
         #By default, if no path is given, it adds to the python path
@@ -206,40 +273,497 @@ class Pipeline(BaseModule):
             logging.debug("Adding potential useful paths to the pythonpath: {0}"
                           .format(pythonpathdir))
 
+        config = ConfigMatcher(config, self.work_path)
+
+        def make_job(module):
+            job = KybJob(run_clmodule, [module],
+                pythonpathdir=pythonpathdir,
+                logdir=os.path.abspath(module.work_path))
+            self.apply_config(config, module, job)
+            if resources:
+                user_settings = user_config.settings(module.work_path) \
+                    if user_config else {}
+                for k, v in resources.settings(module).iteritems():
+                    if k not in user_settings:
+                        setattr(job, k, v)
+            for pin in module.pins.itervalues():
+                pin.set_local(executor.same_node)
+            run_options = dict((k, getattr(job, k)) for k in RUN_OPTIONS
+                               if getattr(job, k, None) is not None)
+            if run_options:
+                job.kwlist = dict(job.kwlist, **run_options)
+            return job
+
+        def pack_jobs(modules, jobs):
+            '''Runs the short modules with the same settings together (see
+            ResourceEstimator.pack). Returns the jobs to be run and a
+            dictionary with the jobs of the modules packed in each of them,
+            which stays in the driver instead of being sent to the node'''
+            def key(module):
+                return repr(sorted((k, v) for k, v in
+                                   config.settings(module.work_path).iteritems()
+                                   if k not in ESTIMATED_SETTINGS))
+            module_jobs = dict(zip(modules, jobs))
+            run_jobs = []
+            packed = {}
+            for group in resources.pack(modules, key):
+                if len(group) == 1:
+                    run_jobs.append(module_jobs[group[0]])
+                    continue
+                members = [module_jobs[m] for m in group]
+                job = KybJob(run_clmodules,
+                             [group, [m.kwlist for m in members]],
+                             pythonpathdir=pythonpathdir,
+                             logdir=os.path.abspath(group[0].work_path))
+                self.apply_config(config, group[0], job)
+                job.h_vmem = max(members, key=lambda j:
+                                 parse_memory(j.h_vmem)).h_vmem
+                job.h_cpu = format_time(sum(parse_time(j.h_cpu)
+                                            for j in members))
+                packed[job] = members
+                logging.debug("Packing {0} modules in a job".format(len(group)))
+                run_jobs.append(job)
+            return run_jobs, packed
+
         with contextlib.nested(*self.ctx_mgrs):
             if debug:
                 #give time for context managers to initialize
                 #(for kyototycoon debugging)
                 time.sleep(1)
-            for i_stage, stage in enumerate(self.stages):
+            own_executor = not executor
+            if own_executor:
+                executor = GridExecutor(local=debug)
+            retrying = config.defines('retries') or \
+                config.defines('speculative')
+            if retrying:
+                executor = RetryingExecutor(executor)
+            self.stage_times = {}
+            try:
+                if schedule == 'dag':
+                    self.run_dag(make_job, executor, resume, init_stage,
+                                 cache)
+                elif schedule == 'stages':
+                    #packing saves the scheduling overhead of short jobs
+                    #on the grid
+                    pack = resources and resources.pack_below and \
+                        not executor.same_node
+                    self.run_stages(make_job, executor, resume, init_stage,
+                                    cache, pack_jobs if pack else None)
+                else:
+                    raise ValueError("Unknown schedule '{0}'".format(schedule))
+            finally:
+                if own_executor:
+                    executor.shutdown()
+                elif retrying:
+                    executor.stop()
+                self.save_stats()
+                if resources:
+                    resources.save()
+
+    def submit(self, **kwargs):
+        '''
+        Runs the pipeline in the background and returns a PipelineRun, from
+        which the progress can be followed, waited for or cancelled (see
+        clutils.submission). Accepts the same arguments as run
+        '''
+        from clutils.submission import PipelineRun
+        return PipelineRun(self, kwargs)
+
+    def set_status(self, module, status):
+        '''Notifies the status of a module (pending, running, done, failed,
+        skipped, cached or cancelled) to the status listeners'''
+        if status in ('done', 'skipped', 'cached'):
+            self.finished_modules.add(module)
+        for listener in self.status_listeners:
+            listener(module, status)
+
+    def check_cancelled(self, modules):
+        if self.cancel_event.is_set():
+            for module in modules:
+                self.set_status(module, 'cancelled')
+            raise PipelineCancelled("The pipeline was cancelled")
+
+    def save_stats(self):
+        '''Writes the modules of each stage and the time each stage took,
+        which are aggregated by clutils.report'''
+        save_stats(os.path.join(self.work_path, PIPELINE_STATS_FILENAME),
+                   {'stages': [[m.work_path for m in stage]
+                               for stage in self.stages],
+                    'stage_times': self.stage_times})
+
+    def prepare(self, modules, resume, cache):
+        '''
+        Returns the modules that need to be run, i.e. those which are not
+        finished (when resuming) and whose outputs are not in the cache.
+        The directories of the modules are created here, in parallel, so the
+        skipped modules don't touch the file system. The modules that were
+        found finished without the manifest, or in the cache, are recorded
+        in the manifest, so the next resume doesn't need to check them again
+        '''
+        finished = []
+        if resume:
+            run_modules = []
+            for module in modules:
+                if self.module_finished(module, resume):
+                    logging.info("{0}: SKIP".format(module))
+                    self.set_status(module, 'skipped')
+                    if not self.manifest.finished(module):
+                        finished.append(module)
+                else:
+                    run_modules.append(module)
+        else:
+            run_modules = list(modules)
+        mkdirs_parallel([d for m in run_modules
+                         for d in self.pending_dirs.pop(m, [])])
+        if cache:
+            cached = [m for m in run_modules if cache.fetch(m)]
+            for module in cached:
+                self.set_status(module, 'cached')
+            finished.extend(cached)
+            run_modules = [m for m in run_modules if m not in cached]
+        self.manifest.record_done(*finished)
+        return run_modules
+
+    def skip_stages(self, init_stage):
+        '''Records the modules of the stages before init_stage, which are
+        assumed to be finished, in the manifest'''
+        skipped = [m for stage in self.stages[:init_stage] for m in stage]
+        self.finished_modules.update(skipped)
+        self.manifest.record_done(*[m for m in skipped
+                                    if not self.manifest.finished(m)])
+
+    def module_finished(self, module, resume=True):
+        if self.use_manifest:
+            finished = self.manifest.finished(module,
+                                              verify=(resume == 'verify'))
+        else:
+            finished = module.finished()
+        if not finished:
+            return False
+        #the shared memory of the module is needed if any of the modules
+        #that read it must be run again
+        for pin in module.pins.itervalues():
+            if id(pin) in self.shared_pins and not pin.file_exists():
+                _, consumers = self.shared_pins[id(pin)]
+                if not all(self.module_finished(m, resume) for m in consumers):
+                    return False
+        return True
+
+    def shared_memory_consumers(self):
+        '''Maps the ids of the SharedMemoryPins that are read by modules of
+        the pipeline to the pins and the sets of modules that read them'''
+        consumers = {}
+        for stage in self.stages:
+            for module in stage:
+                for pin in module.pins.itervalues():
+                    for source in pin.sources():
+                        if isinstance(source, SharedMemoryPin):
+                            consumers.setdefault(id(source),
+                                                 (source, set()))[1].add(module)
+        return consumers
+
+    def release(self):
+        '''Disposes the SharedMemoryPins whose readers have all finished.
+        The ones that are only read by the pipeline pins are kept (see
+        dispose)'''
+        for key, (pin, consumers) in self.shared_pins.items():
+            if consumers <= self.finished_modules:
+                pin.dispose()
+                del self.shared_pins[key]
+
+    def dispose(self):
+        '''Disposes the SharedMemoryPins of all the modules'''
+        for stage in self.stages:
+            for module in stage:
+                for pin in module.pins.itervalues():
+                    if isinstance(pin, SharedMemoryPin):
+                        pin.dispose()
+
+    def record(self, module, job):
+        '''Records in the manifest whether the job of the module succeeded,
+        and returns it'''
+        ok = getattr(job, 'ret', None) is True
+        if self.resources:
+            self.resources.record(module, ok)
+        if ok:
+            self.manifest.record_done(module)
+            self.set_status(module, 'done')
+        else:
+            self.manifest.record_failed(module)
+            self.set_status(module, 'failed')
+        return ok
+
+    def run_stages(self, make_job, executor, resume=False, init_stage=0,
+                   cache=None, pack_jobs=None):
+        '''
+        Runs the stages one after another, waiting for all the modules of a
+        stage to finish before starting the next one.
+        pack_jobs: function that, given the modules and their jobs, returns
+            the jobs to run, where several of them may be packed into one,
+            and a dictionary with the jobs packed into each of them
+        '''
+        self.skip_stages(init_stage)
+        for i_stage, stage in enumerate(self.stages):
+            if i_stage < init_stage:
+                continue
+            self.check_cancelled([m for later_stage in self.stages[i_stage:]
+                                  for m in later_stage])
+            start_time = time.time()
+            run_modules = self.prepare(stage, resume, cache)
+            jobs = [make_job(m) for m in run_modules]
+            run_jobs, packed = pack_jobs(run_modules, jobs) if pack_jobs \
+                else (jobs, {})
+            for module in run_modules:
+                self.set_status(module, 'running')
+            done = []
+            try:
+                executor.process_jobs(run_jobs)
+            finally:
+                for job, members in packed.iteritems():
+                    ret = getattr(job, 'ret', None)
+                    if not isinstance(ret, list):
+                        #the whole job failed
+                        ret = [ret] * len(members)
+                    for member, member_ret in zip(members, ret):
+                        member.ret = member_ret
+                for module, job in zip(run_modules, jobs):
+                    if self.record(module, job):
+                        done.append(module)
+            for module in stage:
+                module.finalize()
+            self.stage_times[i_stage] = time.time() - start_time
+            if cache:
+                #the outputs of the failed modules may be missing or partial
+                for module in done:
+                    cache.store(module)
+            #after storing, since the cache keys read the inputs
+            self.release()
+
+    def dependencies(self):
+        '''
+        Returns a dictionary that maps every module to the set of modules
+        that it depends on. A module depends on another one if any of its
+        pins reads from a pin of the other module. Modules that are not
+        connected to any other module fall back to the stage ordering, i.e.
+        they depend on every module of the previous stages.
+        '''
+        owners = {}
+        for stage in self.stages:
+            for module in stage:
+                for pin in module.pins.itervalues():
+                    owners[id(pin)] = module
+        deps = {}
+        for i_stage, stage in enumerate(self.stages):
+            for module in stage:
+                upstream = set()
+                for pin in module.pins.itervalues():
+                    for source in pin.sources():
+                        owner = owners.get(id(source))
+                        if owner is not None and owner is not module:
+                            upstream.add(owner)
+                if not upstream:
+                    for prev_stage in self.stages[:i_stage]:
+                        upstream.update(prev_stage)
+                deps[module] = upstream
+        return deps
+
+    def run_dag(self, make_job, executor, resume=False, init_stage=0,
+                cache=None):
+        '''
+        Runs the modules following the dependencies given by the pin
+        connections: each module is submitted as soon as all the modules it
+        depends on have finished, instead of waiting for the whole stage.
+        '''
+        from concurrent.futures import wait, FIRST_COMPLETED
+        deps = self.dependencies()
+        self.skip_stages(init_stage)
+        done = set()
+        pending = []
+        for i_stage, stage in enumerate(self.stages):
+            for module in stage:
                 if i_stage < init_stage:
+                    done.add(module)
+                else:
+                    pending.append(module)
+        running = {}
+        error = None
+        while running or (pending and error is None):
+            if error is None and self.cancel_event.is_set():
+                error = PipelineCancelled("The pipeline was cancelled")
+                for future in running:
+                    future.cancel()
+            ready = [m for m in pending if deps[m] <= done] \
+                if error is None else []
+            for module in ready:
+                pending.remove(module)
+            run_modules = self.prepare(ready, resume, cache)
+            done.update(set(ready) - set(run_modules))
+            for module in run_modules:
+                job = make_job(module)
+                self.set_status(module, 'running')
+                running[executor.submit(job)] = (module, job)
+            if not running:
+                if pending and any(deps[m] <= done for m in pending):
+                    #some modules were skipped, so new ones may be ready
                     continue
-                jobs = []
-                for module in stage:
-                    if not resume or not module.finished():
-                        job = KybJob(run_clmodule, [module],
-                            pythonpathdir=pythonpathdir,
-                            logdir=os.path.abspath(module.work_path))
-                        self.apply_config(config, module, job)
-                        jobs.append(job)
-                    elif resume:
-                        logging.info("{0}: SKIP".format(module))
-                process_jobs(jobs, local=debug)
-                for module in stage:
-                    module.finalize()
-                    
+                if pending and error is None:
+                    raise RuntimeError("Cyclic dependencies between modules: "
+                                       "{0}".format(pending))
+                break
+            #wake up from time to time to check whether it was cancelled
+            finished, _ = wait(running, timeout=1,
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                module, job = running.pop(future)
+                if future.cancelled():
+                    self.set_status(module, 'cancelled')
+                    continue
+                e = future.exception()
+                if not self.record(module, job):
+                    #pythongrid reports the failures through job.ret
+                    if e is None:
+                        ret = getattr(job, 'ret', None)
+                        e = ret if isinstance(ret, Exception) else \
+                            RuntimeError("{0}: the job failed ({1})".format(
+                                module, ret))
+                    logging.error("{0}: FAILED ({1})".format(module, e))
+                    error = error or e
+                    continue
+                module.finalize()
+                if cache:
+                    cache.store(module)
+                done.add(module)
+                self.release()
+        if error is not None:
+            if isinstance(error, PipelineCancelled):
+                for module in pending:
+                    self.set_status(module, 'cancelled')
+            raise error
+
+
+def run_clmodules(modules, options, claim=None):
+    '''Runs several modules one after another inside a single job (see
+    ResourceEstimator.pack). options are the keyword arguments of
+    run_clmodule for each module. Returns the result of each module: True
+    or the error with which it failed'''
+    results = []
+    for module, kwargs in zip(modules, options):
+        try:
+            results.append(run_clmodule(module, claim=claim, **kwargs))
+        except SupersededError, e:
+            logging.info("{0}: superseded by another copy".format(module))
+            results.append(e)
+        except Exception, e:
+            logging.error("{0}: FAILED ({1})".format(module, e))
+            results.append(e)
+    return results
+
+
+def cpu_time():
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_virtual_memory(field='VmPeak'):
+    '''Returns the peak address space size of the process in bytes, which is
+    what h_vmem limits, or with field='VmHWM' its peak resident memory (only
+    available on Linux)'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    '''Resets the peak resident memory (VmHWM) of the process, so it can be
+    measured again for the next job of a reused worker. Returns whether it
+    could be reset (Linux >= 4.0)'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+
+#jobs that were run by this process. The peak memory of the process covers
+#all of them, e.g. in the workers of a LocalPoolExecutor or in debug mode
+_jobs_run = 0
+
+
+def children_cpu_time():
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_clmodule(module, profile=None, claim=None):
+    '''
+    Runs a module inside a job.
+    profile: profile the run method (see clutils.profiling.profiled). It can
+        be enabled for some modules through the "profile" setting of the
+        configuration, e.g. {'count/big_corpus*': {'profile': 'cprofile'}}
+    claim: identifies this copy of the job when several copies run at once
+        (see RetryingExecutor), so that only one of them writes the results
+    '''
+    with claimed_writes(module.work_path, claim):
+        return _run_clmodule(module, profile)
+
 
-def run_clmodule(module):
+def _run_clmodule(module, profile):
+    global _jobs_run
+    import resource
     logging.info("{0}: running".format(module))
+    reused = _jobs_run > 0
+    _jobs_run += 1
+    rss_reset = reused and reset_peak_rss()
+    start_time = time.time()
+    start_cpu_time = cpu_time()
+    start_children_cpu_time = children_cpu_time()
     try:
-        module.run(*module.args)
+        with profiled(profile, module.work_path):
+            module.run(*resolve(module.args))
     except AttributeError, e:
         if 'run' in e.message:
             raise RuntimeError("You must define the run method in the JobModule "
                            "instance.")
         else: raise
+    run_time = time.time() - start_time
+    bytes_read = dict((name, pin.bytes_read())
+                      for name, pin in module.pins.iteritems())
     logging.info("{0}: closing pins".format(module))
+    close_start_time = time.time()
     module.close_pins()
+    close_time = time.time() - close_start_time
     logging.info("{0}: finalizing".format(module))
     module.finalize()
+    save_stats(os.path.join(module.work_path, MODULE_STATS_FILENAME), {
+        'wall_time': time.time() - start_time,
+        'run_time': run_time,
+        #time spent closing the pins, i.e. serializing the outputs
+        'close_time': close_time,
+        'cpu_time': cpu_time() - start_cpu_time,
+        #peak resident memory of the process that ran the job (in bytes).
+        #When the process already ran other jobs, the peaks that can't be
+        #reset are unknown (None)
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            if not reused else
+            peak_virtual_memory('VmHWM') if rss_reset else None,
+        'max_vm': peak_virtual_memory() if not reused else None,
+        #the same for the commands it ran, e.g. in a CommandLineJob
+        'children_cpu_time': children_cpu_time() - start_children_cpu_time,
+        'children_max_rss':
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            if not reused else None,
+        'worker_reused': reused,
+        'bytes_read': bytes_read,
+        'bytes_written': dict((name, pin.bytes_written())
+                              for name, pin in module.pins.iteritems()),
+        'host': os.uname()[1],
+    })
     return True
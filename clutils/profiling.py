@@ -0,0 +1,83 @@
+import contextlib
+import logging
+import os
+import signal
+from collections import Counter
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+class SamplingProfiler(object):
+    '''
+    Low-overhead profiler that samples the stack of the main thread every
+    interval seconds of CPU time. The samples are dumped in the folded
+    format used by flamegraph.pl ("f1;f2;f3 count")
+    '''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{0} ({1}:{2})'.format(code.co_name,
+                os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+
+
+@contextlib.contextmanager
+def profiled(mode, work_path):
+    '''
+    Profiles the code run inside the context and dumps the results in
+    work_path.
+    mode: None (no profiling), 'cprofile' (dumps profile.prof, readable
+        with pstats) or 'sample' (dumps profile.folded)
+    '''
+    if not mode:
+        yield
+        return
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        filename = os.path.join(work_path, 'profile.prof')
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(filename)
+    elif mode == 'sample':
+        profiler = SamplingProfiler()
+        filename = os.path.join(work_path, 'profile.folded')
+        try:
+            profiler.start()
+        except ValueError:
+            #signals can only be handled in the main thread
+            logging.warning("Cannot sample the stack outside the main thread."
+                            " The job won't be profiled")
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.stop()
+            profiler.dump(filename)
+    else:
+        raise ValueError("Unknown profile mode '{0}'. Choose one of {1}"
+                         .format(mode, PROFILE_MODES))
+    logging.info("Profile written to {0}".format(filename))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+from clutils.aux import atomic_open
+
+MODULE_STATS_FILENAME = 'stats.json'
+PIPELINE_STATS_FILENAME = 'pipeline_stats.json'
+
+
+def save_stats(filename, stats):
+    with atomic_open(filename, 'w') as f:
+        json.dump(stats, f, indent=1, sort_keys=True)
+
+
+def load_stats(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if not n:
+        return 0
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+def stage_report(work_paths, straggler_factor=2.0):
+    '''Aggregates the stats of the modules of a stage'''
+    modules = []
+    for work_path in work_paths:
+        stats = load_stats(os.path.join(work_path, MODULE_STATS_FILENAME))
+        if stats:
+            modules.append((work_path, stats))
+    wall_times = [s['wall_time'] for _, s in modules]
+    stage_median = median(wall_times)
+    return {
+        'modules': len(work_paths),
+        'measured': len(modules),
+        'wall_time_median': stage_median,
+        'wall_time_max': max(wall_times or [0]),
+        'cpu_time': sum(s['cpu_time'] for _, s in modules),
+        'close_time': sum(s['close_time'] for _, s in modules),
+        'max_rss': max([s['max_rss'] or 0 for _, s in modules] or [0]),
+        'bytes_read': sum(sum(s['bytes_read'].values()) for _, s in modules),
+        'bytes_written': sum(sum(s['bytes_written'].values())
+                             for _, s in modules),
+        'stragglers': sorted([(w, s['wall_time']) for w, s in modules
+                              if len(modules) > 1 and
+                              s['wall_time'] > straggler_factor * stage_median],
+                             key=lambda x: -x[1]),
+    }
+
+
+def pipeline_report(work_path, straggler_factor=2.0):
+    pipeline_stats = load_stats(os.path.join(work_path,
+                                             PIPELINE_STATS_FILENAME))
+    if pipeline_stats is None:
+        raise IOError("No pipeline stats found in {0}".format(work_path))
+    report = []
+    for i, work_paths in enumerate(pipeline_stats['stages']):
+        stage = stage_report(work_paths, straggler_factor)
+        stage['stage'] = i
+        stage['wall_time'] = pipeline_stats['stage_times'].get(str(i))
+        report.append(stage)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=
+    '''Aggregates the performance stats of a pipeline run per stage''')
+    parser.add_argument('work_path', help='work path of the pipeline')
+    parser.add_argument('-f', '--straggler-factor', type=float, default=2.0,
+                        help='modules that take longer than this factor times '
+                        'the median of their stage are reported as stragglers')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='print the report as JSON')
+    args = parser.parse_args()
+
+    report = pipeline_report(args.work_path, args.straggler_factor)
+    if args.json:
+        print json.dumps(report, indent=1, sort_keys=True)
+        return
+    for stage in report:
+        print "Stage {0}: {1} modules ({2} measured)".format(stage['stage'],
+                                        stage['modules'], stage['measured'])
+        if stage['wall_time'] is not None:
+            print "  stage wall time: {0:.1f}s".format(stage['wall_time'])
+        print "  job wall time: median {0:.1f}s, max {1:.1f}s".format(
+            stage['wall_time_median'], stage['wall_time_max'])
+        print "  cpu time: {0:.1f}s, closing pins: {1:.1f}s".format(
+            stage['cpu_time'], stage['close_time'])
+        print "  peak RSS: {0:.1f}MB".format(stage['max_rss'] / 1024.0 ** 2)
+        print "  read: {0:.1f}MB, written: {1:.1f}MB".format(
+            stage['bytes_read'] / 1024.0 ** 2,
+            stage['bytes_written'] / 1024.0 ** 2)
+        for work_path, wall_time in stage['stragglers']:
+            print "  STRAGGLER {0}: {1:.1f}s".format(work_path, wall_time)
+
+
+if __name__ == "__main__":
+    main()
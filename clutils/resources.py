@@ -0,0 +1,176 @@
+import json
+import logging
+import math
+import os
+from clutils.aux import atomic_open
+from clutils.executors import parse_memory
+from clutils.report import load_stats, MODULE_STATS_FILENAME
+
+#settings that are estimated, and that can differ between the modules that
+#are packed into the same job
+ESTIMATED_SETTINGS = ('h_vmem', 'h_cpu')
+
+
+def parse_time(value):
+    '''Converts a SGE time specification ("h:m:s" or seconds) into seconds'''
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, long, float)):
+        return value
+    seconds = 0
+    for part in str(value).split(':'):
+        seconds = seconds * 60 + float(part or 0)
+    return seconds
+
+
+def format_time(seconds):
+    seconds = int(math.ceil(seconds))
+    return "{0}:{1:02d}:{2:02d}".format(seconds // 3600, seconds // 60 % 60,
+                                        seconds % 60)
+
+
+def format_memory(n_bytes):
+    return "{0}M".format(int(math.ceil(n_bytes / 1024.0 ** 2)))
+
+
+class ResourceEstimator(object):
+    '''
+    Estimates the h_vmem and h_cpu of each job from the peak memory (address
+    space if it was measured, otherwise resident memory) and the time that
+    its module took in the previous run (see clutils.report),
+    multiplied by margin and with at least min_memory and min_cpu seconds.
+    If a job that used these estimates fails (e.g. it was killed for
+    exceeding them), the margin of its module is doubled in the next run,
+    until it succeeds again.
+    Modules that took less than pack_below seconds can be run together in
+    jobs of about pack_duration seconds (see pack).
+    The measurements of all the modules are kept in a single summary file
+    in the work path of the pipeline, which is read when the run starts
+    (see load) and updated when it ends (see save), so the driver doesn't
+    read a file per module before submitting the jobs
+    '''
+    summary_filename = 'resources.json'
+    #the stats of each module that are used for the estimates
+    stats_keys = ('wall_time', 'cpu_time', 'max_rss', 'max_vm',
+                  'children_cpu_time', 'children_max_rss', 'worker_reused')
+
+    def __init__(self, margin=1.5, min_memory='256M', min_cpu=60,
+                 pack_below=30, pack_duration=600):
+        self.margin = margin
+        self.min_memory = parse_memory(min_memory)
+        self.min_cpu = min_cpu
+        self.pack_below = pack_below
+        self.pack_duration = pack_duration
+        self.work_path = None
+        self.summary = {}
+        #modules whose jobs were given estimated settings
+        self.estimated = set()
+        #modules that succeeded in this run, whose stats are saved
+        self.succeeded = []
+
+    def load(self, work_path):
+        '''Reads the measurements of the previous runs of the pipeline in
+        work_path'''
+        self.work_path = work_path
+        self.summary = load_stats(os.path.join(work_path,
+                                               self.summary_filename)) or {}
+        self.estimated = set()
+        self.succeeded = []
+
+    def key(self, module):
+        return os.path.relpath(module.work_path, self.work_path)
+
+    def measured(self, module):
+        '''Returns the stats of the previous run of the module'''
+        return self.summary.get(self.key(module), {}).get('stats')
+
+    def failures(self, module):
+        return self.summary.get(self.key(module), {}).get('failures', 0)
+
+    def settings(self, module):
+        '''Returns the estimated settings of the module, or an empty
+        dictionary if it was never run'''
+        stats = self.measured(module)
+        if not stats:
+            return {}
+        self.estimated.add(module)
+        margin = self.margin * 2 ** self.failures(module)
+        cpu = max(stats['cpu_time'] + (stats.get('children_cpu_time') or 0),
+                  stats['wall_time'])
+        settings = {'h_cpu': format_time(max(cpu * margin, self.min_cpu))}
+        #the peak memory is unknown when the job ran in a reused worker
+        memory = stats.get('max_vm') or stats.get('max_rss')
+        if memory:
+            memory += stats.get('children_max_rss') or 0
+            settings['h_vmem'] = format_memory(max(memory * margin,
+                                                   self.min_memory))
+        return settings
+
+    def record(self, module, succeeded):
+        '''Keeps track of the modules that succeeded, and of the failures
+        of the jobs that used estimates'''
+        if succeeded:
+            self.succeeded.append(module)
+        if module not in self.estimated:
+            return
+        entry = self.summary.setdefault(self.key(module), {})
+        if succeeded:
+            entry.pop('failures', None)
+            return
+        entry['failures'] = self.failures(module) + 1
+        logging.warning("{0}: failed with estimated resources, they will be "
+                        "multiplied by {1} in the next run".format(
+                            module, 2 ** entry['failures']))
+
+    def save(self, threads=16):
+        '''Adds the stats of the modules that succeeded in this run to the
+        summary file. They are read in parallel, as each module wrote its
+        own'''
+        if self.work_path is None:
+            return
+        def read(module):
+            return load_stats(os.path.join(module.work_path,
+                                           MODULE_STATS_FILENAME))
+        if len(self.succeeded) > 1 and threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(threads, len(self.succeeded)))
+            try:
+                all_stats = pool.map(read, self.succeeded)
+            finally:
+                pool.close()
+        else:
+            all_stats = map(read, self.succeeded)
+        for module, stats in zip(self.succeeded, all_stats):
+            if stats:
+                self.summary.setdefault(self.key(module), {})['stats'] = \
+                    dict((k, stats.get(k)) for k in self.stats_keys)
+        self.succeeded = []
+        with atomic_open(os.path.join(self.work_path, self.summary_filename),
+                         'w') as f:
+            json.dump(self.summary, f, indent=1, sort_keys=True)
+
+    def pack(self, modules, key):
+        '''
+        Groups the modules that took less than pack_below seconds and have
+        the same key (e.g. the same configuration) into lists whose total
+        time is about pack_duration. The rest of the modules are returned
+        alone. Returns a list of lists of modules
+        '''
+        groups = []
+        #the group that is being filled for each key, and its duration
+        filling = {}
+        for module in modules:
+            stats = self.measured(module)
+            if not stats or stats['wall_time'] >= self.pack_below or \
+                    self.failures(module):
+                groups.append([module])
+                continue
+            k = key(module)
+            if k not in filling:
+                filling[k] = [[], 0]
+                groups.append(filling[k][0])
+            filling[k][0].append(module)
+            filling[k][1] += stats['wall_time']
+            if filling[k][1] >= self.pack_duration:
+                del filling[k]
+        return groups
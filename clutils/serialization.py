@@ -1,5 +1,10 @@
 import pickle
+import cPickle
+import mmap
 import os
+import struct
+from collections import Mapping
+from clutils.aux import atomic_open
 
 class ClBaseSerializer(object):
     def __init__(self, filename):
@@ -11,22 +16,242 @@ class PklSerializer(ClBaseSerializer):
     def __init__(self, filename):
         super(PklSerializer, self).__init__(filename + '.pkl')
     def save_dict(self, d):
-        pickle.dump(d, file(self.filename, 'w'))
+        with atomic_open(self.filename, 'w') as f:
+            pickle.dump(d, f)
     def save_scalar(self, s):
-        pickle.dump(s, file(self.filename, 'w'))
+        with atomic_open(self.filename, 'w') as f:
+            pickle.dump(s, f)
     def read(self):
-        return pickle.load(file(self.filename))
+        with open(self.filename) as f:
+            return pickle.load(f)
+
+class BinPklSerializer(PklSerializer):
+    '''Pickles with cPickle and the highest (binary) protocol, which is much
+    faster and smaller than the default ASCII protocol'''
+    def save_dict(self, d):
+        with atomic_open(self.filename, 'wb') as f:
+            cPickle.dump(d, f, cPickle.HIGHEST_PROTOCOL)
+    def save_scalar(self, s):
+        with atomic_open(self.filename, 'wb') as f:
+            cPickle.dump(s, f, cPickle.HIGHEST_PROTOCOL)
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            return cPickle.load(f)
+
+class MsgpackSerializer(ClBaseSerializer):
+    '''Serializes with msgpack (requires the msgpack package). Only supports
+    basic types: dictionaries are read back as plain dicts and tuples as
+    lists'''
+    def __init__(self, filename):
+        super(MsgpackSerializer, self).__init__(filename + '.msgpack')
+    def save_dict(self, d):
+        import msgpack
+        with atomic_open(self.filename, 'wb') as f:
+            msgpack.pack(dict(d), f)
+    def save_scalar(self, s):
+        import msgpack
+        with atomic_open(self.filename, 'wb') as f:
+            msgpack.pack(s, f)
+    def read(self):
+        import msgpack
+        with open(self.filename, 'rb') as f:
+            return msgpack.unpack(f)
+
+class NpySerializer(ClBaseSerializer):
+    '''Stores a NumPy array in the .npy format. If mmap_mode is given
+    (e.g. 'r'), the array is memory-mapped when read instead of loaded'''
+    def __init__(self, filename, mmap_mode=None):
+        super(NpySerializer, self).__init__(filename + '.npy')
+        self.mmap_mode = mmap_mode
+    def save_dict(self, d):
+        raise TypeError("NpySerializer can only store arrays. Use "
+                        "NpzSerializer for dictionaries of arrays")
+    def save_scalar(self, s):
+        import numpy as np
+        with atomic_open(self.filename, 'wb') as f:
+            np.save(f, s)
+    def read(self):
+        import numpy as np
+        return np.load(self.filename, mmap_mode=self.mmap_mode)
+
+class NpzSerializer(ClBaseSerializer):
+    '''Stores a dictionary of NumPy arrays in the .npz format'''
+    def __init__(self, filename, compressed=False):
+        super(NpzSerializer, self).__init__(filename + '.npz')
+        self.compressed = compressed
+    def save_dict(self, d):
+        import numpy as np
+        save = np.savez_compressed if self.compressed else np.savez
+        with atomic_open(self.filename, 'wb') as f:
+            save(f, **dict(d))
+    def save_scalar(self, s):
+        raise TypeError("NpzSerializer can only store dictionaries of arrays."
+                        " Use NpySerializer for single arrays")
+    def read(self):
+        import numpy as np
+        with np.load(self.filename) as npz:
+            return dict(npz.items())
+
+_length = struct.Struct('<I')
+
+def encode_key(k):
+    '''
+    Canonical encoding of a key of a SortedDictSerializer: keys that are
+    equal in a dict (e.g. 'a' and u'a', or 1 and 1.0) have the same
+    encoding. Supports strings, numbers and tuples of them
+    '''
+    if isinstance(k, str):
+        return 's' + k
+    if isinstance(k, unicode):
+        try:
+            return 's' + k.encode('ascii')
+        except UnicodeEncodeError:
+            return 'u' + k.encode('utf-8')
+    if isinstance(k, float) and not k.is_integer():
+        return 'f' + repr(k)
+    if isinstance(k, (int, long, float)):
+        return 'i' + str(int(k))
+    if isinstance(k, tuple):
+        encoded = [encode_key(e) for e in k]
+        return 't' + ''.join(_length.pack(len(e)) + e for e in encoded)
+    raise TypeError("Unsupported key type for a sorted dictionary: "
+                    "{0}".format(type(k).__name__))
+
+def decode_key(raw):
+    tag, data = raw[0], raw[1:]
+    if tag == 's':
+        return data
+    if tag == 'u':
+        return data.decode('utf-8')
+    if tag == 'f':
+        return float(data)
+    if tag == 'i':
+        return int(data)
+    elements = []
+    offset = 0
+    while offset < len(data):
+        size, = _length.unpack_from(data, offset)
+        offset += _length.size
+        elements.append(decode_key(data[offset:offset + size]))
+        offset += size
+    return tuple(elements)
+
+class MappedDict(Mapping):
+    '''
+    Read-only dictionary over a file written by SortedDictSerializer. The
+    file is memory-mapped: lookups are binary searches over the sorted keys
+    and only the requested values are unpickled
+    '''
+    header = struct.Struct('<8sQ')
+    entry = struct.Struct('<QQ')
+    magic = 'CLSDICT2'
+
+    def __init__(self, filename):
+        self.f = open(filename, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n = self.header.unpack_from(self.mm, 0)
+        if magic != self.magic:
+            raise ValueError("{0} is not a sorted dictionary file".format(
+                                                                    filename))
+
+    def _offsets(self, i):
+        return self.entry.unpack_from(self.mm,
+                                      self.header.size + i * self.entry.size)
+
+    def _raw_key(self, i):
+        key_offset, value_offset = self._offsets(i)
+        return self.mm[key_offset:value_offset]
+
+    def _raw_value(self, i):
+        _, value_offset = self._offsets(i)
+        next_key_offset, _ = self._offsets(i + 1)
+        return self.mm[value_offset:next_key_offset]
+
+    def _find(self, raw_key):
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw_key(mid) < raw_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n and self._raw_key(lo) == raw_key:
+            return lo
+        return None
+
+    def __getitem__(self, k):
+        try:
+            i = self._find(encode_key(k))
+        except TypeError:
+            raise KeyError(k)
+        if i is None:
+            raise KeyError(k)
+        return cPickle.loads(self._raw_value(i))
+
+    def __contains__(self, k):
+        try:
+            return self._find(encode_key(k)) is not None
+        except TypeError:
+            return False
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in xrange(self.n):
+            yield decode_key(self._raw_key(i))
+
+    def iteritems(self):
+        for i in xrange(self.n):
+            yield decode_key(self._raw_key(i)), \
+                cPickle.loads(self._raw_value(i))
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+class SortedDictSerializer(ClBaseSerializer):
+    '''
+    Stores a dictionary as its encoded keys (see encode_key), sorted, and
+    pickled values, after an index of offsets, so that it can be read
+    lazily as a MappedDict. Keys must be strings, numbers or tuples of them
+    '''
+    def __init__(self, filename):
+        super(SortedDictSerializer, self).__init__(filename + '.sdict')
+    def save_dict(self, d):
+        keys = sorted((encode_key(k), k) for k in d)
+        n = len(keys)
+        data_offset = MappedDict.header.size + (n + 1) * MappedDict.entry.size
+        index = []
+        with atomic_open(self.filename, 'wb') as f:
+            f.seek(data_offset)
+            offset = data_offset
+            for raw_key, k in keys:
+                raw_value = cPickle.dumps(d[k], 2)
+                index.append(MappedDict.entry.pack(offset,
+                                                   offset + len(raw_key)))
+                f.write(raw_key)
+                f.write(raw_value)
+                offset += len(raw_key) + len(raw_value)
+            index.append(MappedDict.entry.pack(offset, offset))
+            f.seek(0)
+            f.write(MappedDict.header.pack(MappedDict.magic, n))
+            f.write(''.join(index))
+    def save_scalar(self, s):
+        raise TypeError("SortedDictSerializer can only store dictionaries")
+    def read(self):
+        return MappedDict(self.filename)
 
 class TxtSerializer(ClBaseSerializer):
     def __init__(self, filename):
         super(TxtSerializer, self).__init__(filename + '.txt')
     def save_dict(self, d):
-        with open(self.filename, 'w') as f:
+        with atomic_open(self.filename, 'w') as f:
             for k,v in sorted(d.iteritems()):
                 f.write('{0}\t{1}\n'.format(k,v))
     def save_scalar(self, s):
-        with open(self.filename, 'w') as f:
+        with atomic_open(self.filename, 'w') as f:
             f.write("{0}".format(s))
     def read(self):
-        return dict(l.split('\t') for l in file(self.output_path))
-        
\ No newline at end of file
+        with open(self.filename) as f:
+            return dict(l.rstrip('\n').split('\t', 1) for l in f)
@@ -0,0 +1,84 @@
+import logging
+import sys
+import threading
+from collections import Counter
+from Queue import Queue
+
+FINAL_STATUSES = ('done', 'failed', 'skipped', 'cached', 'cancelled')
+
+
+class PipelineRun(object):
+    '''
+    Handle to a pipeline running in the background (see Pipeline.submit).
+    Many pipelines can be submitted at once, sharing the same executor
+    '''
+    def __init__(self, pipeline, run_kwargs):
+        self.pipeline = pipeline
+        self.statuses = {}
+        self.lock = threading.Lock()
+        self.completed = Queue()
+        self.cancel_event = threading.Event()
+        self.exc_info = None
+        pipeline.status_listeners.append(self._on_status)
+        run_kwargs = dict(run_kwargs, cancel_event=self.cancel_event)
+        self.thread = threading.Thread(target=self._run, args=(run_kwargs,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, run_kwargs):
+        try:
+            self.pipeline.run(**run_kwargs)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+            logging.error("Pipeline {0} failed: {1}".format(
+                self.pipeline.work_path, self.exc_info[1]))
+        finally:
+            self.pipeline.status_listeners.remove(self._on_status)
+            #signals the end of the run to as_completed
+            self.completed.put(None)
+
+    def _on_status(self, module, status):
+        with self.lock:
+            self.statuses[module] = status
+        if status in FINAL_STATUSES:
+            self.completed.put((module, status))
+
+    def status(self):
+        '''Returns a dictionary with the status of each module, indexed by
+        its work path'''
+        with self.lock:
+            return dict((module.work_path, status)
+                        for module, status in self.statuses.iteritems())
+
+    def progress(self):
+        '''Returns the number of modules in each status'''
+        with self.lock:
+            return Counter(self.statuses.itervalues())
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def wait(self, timeout=None):
+        '''Waits for the pipeline to finish, re-raising its error if it
+        failed. Returns False if the timeout expired before'''
+        #join with a timeout so that the wait can be interrupted
+        self.thread.join(timeout if timeout is not None else sys.maxint)
+        if self.thread.is_alive():
+            return False
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return True
+
+    def as_completed(self):
+        '''Yields (module, status) as the modules finish, are skipped or are
+        cancelled, until the pipeline ends. Only one consumer is allowed'''
+        while True:
+            item = self.completed.get(True, sys.maxint)
+            if item is None:
+                break
+            yield item
+
+    def cancel(self):
+        '''Stops submitting new jobs. The modules that were not started are
+        cancelled and wait() raises PipelineCancelled'''
+        self.cancel_event.set()
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 import argparse
 from clutils.pipeline import Pipeline
+from clutils.building_blocks import add_split_jobs
 from count_words_defs import CountWords, SumCounts
 import os
 
 def main():
     arg_parser = argparse.ArgumentParser(description='Count words in target')
     arg_parser.add_argument('corpora', nargs='+')
-    arg_parser.add_argument('--to-lower', description='Converts all words to '
+    arg_parser.add_argument('--to-lower', help='Converts all words to '
         'lowercase', action='store_true', default=False)
     arg_parser.add_argument('-z', '--zipped', default=False, action='store_true')
+    arg_parser.add_argument('-s', '--splits', type=int, default=1,
+        help='number of jobs that count each corpus (the corpora must be '
+        'uncompressed or BGZF)')
     arg_parser.add_argument('-o', '--output', required=True)
     
     args = arg_parser.parse_args()
@@ -24,13 +28,23 @@ def main():
         #Create a counting module and use count as a directory to group all the
         # output of the counting modules with the name of the corpus file as
         # sub-directory
-        count_module = CountWords("count", os.path.basename(corpus))
-        #Set the arguments that will be sent to the "run" method
-        count_module.set_args(corpus, args.zipped, args.to_lower)
-        #Connect the output of the count_module to the input of the summing module
-        count_module['output'].connect_to(sum_module['input'])
-        #Add the count_module
-        pln.add_module(count_module)
+        if args.splits > 1:
+            #Split the corpus into many counting modules, each of which reads
+            #only a part of the file (count/<corpus>/<split number>)
+            count_modules = add_split_jobs(pln, CountWords,
+                (corpus, args.zipped, args.to_lower), args.splits,
+                ("count", os.path.basename(corpus)), filename=corpus)
+        else:
+            count_module = CountWords("count", os.path.basename(corpus))
+            #Set the arguments that will be sent to the "run" method
+            count_module.set_args(corpus, args.zipped, args.to_lower)
+            #Add the count_module
+            pln.add_module(count_module)
+            count_modules = [count_module]
+        for count_module in count_modules:
+            #Connect the output of the count_module to the input of the 
+            #summing module
+            count_module['output'].connect_to(sum_module['input'])
     #Create a new stage (the sum_module needs to be run just after all the 
     #count modules have finished
     pln.add_stage()
@@ -37,8 +37,10 @@ class SumCounts(JobModule):
                            DictionaryPin("output", Counter))
     
     def run(self):
-        #Reading the multiplex involves reading each of the connected pins
-        for partial_count in self['input'].read():
+        #Reading the multiplex involves reading each of the connected pins.
+        #They are loaded in the background while we sum the previous ones,
+        #in any order since the sum doesn't depend on it
+        for partial_count in self['input'].read_prefetch(ordered=False):
             #The partial_count is the the read dictionary
             for word, c in partial_count.iteritems():
                 #Count each of the partial counts into a global count
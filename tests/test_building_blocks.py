@@ -0,0 +1,76 @@
+import shutil
+import tempfile
+import unittest
+from operator import add
+from clutils.pipeline import Pipeline, JobModule
+from clutils.pins import DictionaryPin, RecordStreamPin
+from clutils.serialization import SortedDictSerializer
+from clutils.building_blocks import StreamMergeJob, _checked_records, \
+    add_reduction_tree
+from clutils.executors import GridExecutor
+
+
+class Records(JobModule):
+    def setup(self):
+        self.register_pins(RecordStreamPin("output"))
+
+    def run(self, pairs):
+        for pair in pairs:
+            self['output'].write(pair)
+
+
+class SortedDict(JobModule):
+    def setup(self):
+        self.register_pins(DictionaryPin("output",
+                                         serializer_type=SortedDictSerializer))
+
+    def run(self, d):
+        self['output'].write(d)
+
+
+class StreamMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def merge(self, source_class, inputs):
+        pipeline = Pipeline(self.work_path)
+        merge = StreamMergeJob("merge")
+        merge.set_args(add)
+        for i, data in enumerate(inputs):
+            source = source_class("source", str(i))
+            source.set_args(data)
+            source['output'].connect_to(merge['input'])
+            pipeline.add_module(source)
+        pipeline.add_stage(merge)
+        pipeline.run(executor=GridExecutor(local=True))
+        return list(merge['output'].read())
+
+    def test_records(self):
+        self.assertEqual(self.merge(Records, [[(1, 1), (3, 1)],
+                                              [(2, 5), (3, 2)]]),
+                         [(1, 1), (2, 5), (3, 3)])
+
+    def test_unsorted_records(self):
+        #the job fails, so the merged output is never written
+        self.assertRaises(IOError, self.merge, Records,
+                          [[(3, 1), (1, 1)], [(2, 5)]])
+        self.assertRaises(ValueError, list,
+                          _checked_records([(3, 1), (1, 1)], 0))
+
+    def test_sorted_dicts(self):
+        merged = self.merge(SortedDict, [{1: 1, 10: 2, 'a': 3},
+                                         {9: 4, 10: 5, (1, 2): 6}])
+        self.assertEqual(dict(merged), {1: 1, 9: 4, 10: 7, 'a': 3, (1, 2): 6})
+        self.assertEqual(len(merged), 5)
+
+    def test_reduction_tree_fan_in(self):
+        pipeline = Pipeline(self.work_path)
+        self.assertRaises(ValueError, add_reduction_tree, pipeline, [],
+                          lambda *name: StreamMergeJob(*name), fan_in=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
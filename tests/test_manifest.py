@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from clutils.pipeline import Pipeline, JobModule
+from clutils.pins import ScalarPin, PinMultiplex
+from clutils.executors import GridExecutor
+
+
+#the modules that were run, in the current process (see run_pipeline)
+ran = []
+
+
+class Square(JobModule):
+    def setup(self):
+        self.register_pins(ScalarPin("output"))
+
+    def run(self, x):
+        ran.append(self)
+        self['output'].write(x * x)
+
+
+class Sum(JobModule):
+    def setup(self):
+        self.register_pins(PinMultiplex("input"), ScalarPin("output"))
+
+    def run(self):
+        ran.append(self)
+        self['output'].write(sum(self['input'].read()))
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def run_pipeline(self, **kwargs):
+        '''Runs the pipeline and returns the modules that were run'''
+        pipeline = Pipeline(self.work_path)
+        total = Sum("sum")
+        for i in xrange(5):
+            module = Square("square", str(i))
+            module.set_args(i)
+            module['output'].connect_to(total['input'])
+            pipeline.add_module(module)
+        pipeline.add_stage(total)
+        del ran[:]
+        pipeline.run(executor=GridExecutor(local=True), **kwargs)
+        self.assertEqual(total['output'].read(), 30)
+        return list(ran)
+
+    def test_resume_twice(self):
+        self.assertEqual(len(self.run_pipeline()), 6)
+        #a run finished before the manifest existed
+        os.remove(os.path.join(self.work_path, 'state.journal'))
+        self.assertEqual(self.run_pipeline(resume=True), [])
+        self.assertEqual(self.run_pipeline(resume=True), [])
+
+    def test_resume_after_init_stage(self):
+        self.run_pipeline()
+        os.remove(os.path.join(self.work_path, 'state.journal'))
+        self.assertEqual(len(self.run_pipeline(init_stage=1)), 1)
+        self.assertEqual(self.run_pipeline(resume=True), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
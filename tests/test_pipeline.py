@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+from clutils.pipeline import Pipeline, JobModule
+from clutils.pins import ScalarPin, PinMultiplex
+from clutils.executors import GridExecutor
+from clutils.cache import ResultCache, module_key
+
+
+class Fail(JobModule):
+    def setup(self):
+        self.register_pins(ScalarPin("output"))
+
+    def run(self):
+        raise ValueError("failed")
+
+
+class Echo(JobModule):
+    def setup(self):
+        self.register_pins(ScalarPin("output"))
+
+    def run(self, x):
+        if x is None:
+            raise ValueError("failed")
+        self['output'].write(x)
+
+
+class Sum(JobModule):
+    def setup(self):
+        self.register_pins(PinMultiplex("input"), ScalarPin("output"))
+
+    def run(self):
+        self['output'].write(sum(self['input'].read()))
+
+
+class DagTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def test_failed_job_stops_downstream(self):
+        pipeline = Pipeline(self.work_path)
+        source = Fail("fail")
+        total = Sum("sum")
+        source['output'].connect_to(total['input'])
+        pipeline.add_module(source)
+        pipeline.add_stage(total)
+        statuses = {}
+        pipeline.status_listeners.append(
+            lambda module, status: statuses.__setitem__(module, status))
+        self.assertRaises(ValueError, pipeline.run,
+                          executor=GridExecutor(local=True), schedule='dag')
+        self.assertEqual(statuses[source], 'failed')
+        self.assertEqual(statuses[total], 'pending')
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+        shutil.rmtree(self.cache_path)
+
+    def test_failed_modules_are_not_stored(self):
+        pipeline = Pipeline(self.work_path)
+        for i, x in enumerate([1, None, 3]):
+            module = Echo("echo", str(i))
+            module.set_args(x)
+            pipeline.add_module(module)
+        cache = ResultCache(self.cache_path)
+        pipeline.run(executor=GridExecutor(local=True), cache=cache)
+        self.assertEqual(len(cache.entries()), 2)
+        for prefix in os.listdir(self.cache_path):
+            for key in os.listdir(os.path.join(self.cache_path, prefix)):
+                self.assertFalse(key.startswith('tmp'))
+
+    def test_key_follows_input_files(self):
+        corpus = os.path.join(self.work_path, 'corpus.txt')
+        with open(corpus, 'w') as f:
+            f.write('a b')
+        module = Echo("echo")
+        module.initialize(self.work_path)
+        module.set_args(corpus)
+        key = module_key(module)
+        self.assertEqual(module_key(module), key)
+        with open(corpus, 'w') as f:
+            f.write('a b c')
+        self.assertNotEqual(module_key(module), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+from clutils.serialization import SortedDictSerializer
+
+
+class SortedDictSerializerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.serializer = SortedDictSerializer(os.path.join(self.tmp_dir,
+                                                            'dict'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save_and_read(self, d):
+        self.serializer.save_dict(d)
+        return self.serializer.read()
+
+    def test_tuple_keys_with_repeated_elements(self):
+        #the same string object twice, and two different objects
+        the = ''.join(['t', 'he'])
+        other_the = ''.join(['th', 'e'])
+        d = {(the, the): 1, ('the', 'cat'): 2, (('a', 'a'), 'a'): 3}
+        mapped = self.save_and_read(d)
+        self.assertIn((the, other_the), mapped)
+        self.assertEqual(mapped[(the, other_the)], 1)
+        self.assertEqual(mapped[(('a', 'a'), 'a')], 3)
+        self.assertEqual(dict(mapped.iteritems()), d)
+
+    def test_equal_keys_of_different_types(self):
+        mapped = self.save_and_read({'a': 1, 2: 'two', u'\xe9': 3})
+        self.assertEqual(mapped[u'a'], 1)
+        self.assertEqual(mapped[2.0], 'two')
+        self.assertEqual(mapped[u'\xe9'], 3)
+        self.assertNotIn('b', mapped)
+        self.assertNotIn(['a'], mapped)
+
+
+if __name__ == '__main__':
+    unittest.main()